@@ -6,37 +6,216 @@
 # added or when a previously correct media file is corrupted (by bad disk sectors, for example).
 #
 import argparse
+import collections
+import contextlib
+import csv
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import fnmatch
+import hashlib
+import itertools
+import json
 import logging
 import os
+import Queue
 import re
+import select
+import signal
 import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import threading
 import time
+import zlib
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 __version__ = "0.2.6"
 
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024 * 1024
+DISCOVERY_BATCH_SIZE = 10000
+FFMPEG = "/usr/bin/ffmpeg"
+FFPROBE = "/usr/bin/ffprobe"
+GOVERNOR_INTERVAL = 0.1
+LATENCY_SAMPLE_INTERVAL = 1
+MAXIMUM_BACKOFF = 64
+# The coarsest mtime granularity (in seconds) of the filesystems that we expect to scan.
+MTIME_GRANULARITY = 2
+PENDING_BATCH_SIZE = 256
+REPORT_AGE_BUCKETS = [1, 7, 14, 30, 90, 365]
+SCAN_CHUNK_SIZE = 1000
+BUDGET_SKIP_LIMIT = 1000
+SCHEMA_VERSION = 8
+THROUGHPUT_DECAY = 0.9
+TRANSCODE_SAMPLES = 5
+TRANSCODE_SAMPLE_SECONDS = 10
 
-def checksum(path):
-	checksum = None
-	proc = subprocess.Popen(["/usr/bin/cksfv", "-c", path], stderr=subprocess.STDOUT, stdin=open("/dev/null"), stdout=subprocess.PIPE, close_fds=True, cwd="/", env=dict())
-	for line in proc.stdout:
-		line = unicode(line, "utf-8", errors="ignore")
-		if line[0:len(path)] == path:
-			checksum = line[len(path)+1:len(line)]
-	return checksum.rstrip()
+
+class ToolError(Exception):
+	"""
+	An external tool (ffmpeg or ffprobe) could not be run at all.
+	"""
+
+
+class Checksum(object):
+	"""
+	Incrementally computes the CRC32 of a stream of data (formatted exactly as cksfv formats
+	it, so that existing checksums in the database remain valid) and, optionally, a stronger
+	hashlib digest of the same data in the same pass.
+	"""
+	def __init__(self, strong_algorithm=None, crc=0, length=0):
+		self.crc = crc
+		self.length = length
+		self.strong = None
+		self.strong_algorithm = strong_algorithm
+		if strong_algorithm is not None:
+			self.strong = hashlib.new(strong_algorithm)
+
+	def hexdigest(self):
+		return "{crc:08X}".format(crc=self.crc & 0xffffffff)
+
+	def strong_hexdigest(self):
+		if self.strong is None:
+			return None
+		return "{algorithm}:{digest}".format(algorithm=self.strong_algorithm, digest=self.strong.hexdigest())
+
+	def update(self, data):
+		self.crc = zlib.crc32(data, self.crc)
+		self.length += len(data)
+		if self.strong is not None:
+			self.strong.update(data)
+
+
+def checksum(path, strong_algorithm=None, limiter=None):
+	c = Checksum(strong_algorithm)
+	with open(path, "rb") as f:
+		while True:
+			data = f.read(CHECKSUM_BUFFER_SIZE)
+			if not data:
+				break
+			if limiter is not None:
+				limiter.wait(len(data))
+			c.update(data)
+	return c
+
+
+def checksum_chunks(path, offset=0, crc=0, deadline=None, limiter=None):
+	"""
+	Compute the checksum of the media file at path (resuming from the given offset, where
+	crc is the CRC32 of everything before it) and also the CRC32 of each CHUNK_SIZE chunk of
+	it.  If a deadline is given, stop at the first chunk boundary after it has passed.
+	Returns a tuple of the Checksum (whose length is the offset reached), a dictionary mapping
+	chunk indexes to their CRC32s and whether the end of the file was reached.
+	"""
+	c = Checksum(None, crc, offset)
+	chunks = {}
+	with open(path, "rb") as f:
+		f.seek(offset)
+		while True:
+			if (deadline is not None) and (time.time() > deadline):
+				return (c, chunks, False)
+			chunk = Checksum()
+			while chunk.length < CHUNK_SIZE:
+				data = f.read(min(CHECKSUM_BUFFER_SIZE, CHUNK_SIZE - chunk.length))
+				if not data:
+					break
+				if limiter is not None:
+					limiter.wait(len(data))
+				c.update(data)
+				chunk.update(data)
+			if chunk.length > 0:
+				chunks[offset // CHUNK_SIZE] = chunk.hexdigest()
+				offset += chunk.length
+			if chunk.length < CHUNK_SIZE:
+				return (c, chunks, True)
+
+
+def transcode(path, error_limit=None, limiter=None):
+	return run_ffmpeg(["-i", path, "-f", "null", "-"], error_limit, limiter)
+
+
+def sample_transcode(path, error_limit=None, limiter=None):
+	"""
+	Transcode a sample of the media file at path: its keyframes, and TRANSCODE_SAMPLES
+	segments of TRANSCODE_SAMPLE_SECONDS each, spread evenly through it.  Returns the number
+	of transcoding problems encountered, or None if the duration of the media file (and so
+	where to take samples from) could not be determined.
+	"""
+	duration = media_duration(path)
+	if duration is None:
+		return None
+	problems = run_ffmpeg(["-skip_frame", "nokey", "-i", path, "-f", "null", "-"], error_limit, limiter)
+	for i in range(TRANSCODE_SAMPLES):
+		if (error_limit is not None) and (problems >= error_limit):
+			break
+		start = max(0.0, (duration * (i + 0.5) / TRANSCODE_SAMPLES) - (TRANSCODE_SAMPLE_SECONDS / 2.0))
+		problems += run_ffmpeg(["-ss", "{start:.3f}".format(start=start), "-i", path, "-t", str(TRANSCODE_SAMPLE_SECONDS), "-f", "null", "-"], None if error_limit is None else error_limit - problems, limiter)
+	return problems
+
+
+def media_duration(path):
+	proc = start_tool([FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", path], stderr=open("/dev/null", "w"), stdin=open("/dev/null"), stdout=subprocess.PIPE, close_fds=True, cwd="/", env=dict())
+	output = proc.communicate()[0]
+	try:
+		return float(output.strip())
+	except ValueError:
+		return None
 
 
-def transcode(path):
+def run_ffmpeg(options, error_limit=None, limiter=None):
+	"""
+	Run ffmpeg (with the given input and output options) and return the number of problems
+	that it reports.  If an error limit is given, ffmpeg is killed as soon as it has reported
+	that many problems.  If a limiter is given, ffmpeg's reads are held to its rate.
+	"""
+	proc = start_tool([FFMPEG, "-v", "verbose"] + options, stderr=subprocess.STDOUT, stdin=open("/dev/null"), stdout=subprocess.PIPE, close_fds=True, cwd="/", env=dict())
+	if limiter is not None:
+		finished = threading.Event()
+		governor = threading.Thread(target=limiter.govern, args=(proc, finished))
+		governor.daemon = True
+		governor.start()
+	try:
+		problems = count_transcode_problems(proc.stdout, error_limit)
+		if (error_limit is not None) and (problems >= error_limit):
+			proc.kill()
+		proc.stdout.close()
+	finally:
+		if limiter is not None:
+			finished.set()
+			governor.join()
+		proc.wait()
+	return problems
+
+
+def start_tool(command, **options):
+	"""
+	Start an external tool (with the given subprocess.Popen options), raising a ToolError if
+	it cannot be run at all, so that a missing tool is not mistaken for a missing media file.
+	"""
+	try:
+		return subprocess.Popen(command, **options)
+	except OSError, e:
+		raise ToolError(u"unable to run {tool}: {error}".format(error=e.strerror, tool=command[0]))
+
+
+def count_transcode_problems(output, error_limit=None):
 	control_characters = "".join(map(unichr, range(0,32) + range(127, 160)))
 	control_characters_re = re.compile("[%s]" % re.escape(control_characters))
 
 	errors = 0
 	warnings = 0
-	proc = subprocess.Popen(["/usr/bin/ffmpeg", "-v", "verbose", "-i", path, "-f", "null", "-"], stderr=subprocess.STDOUT, stdin=open("/dev/null"), stdout=subprocess.PIPE, close_fds=True, cwd="/", env=dict())
-	for line in proc.stdout:
+	for line in output:
 		line = control_characters_re.sub("", line)
 		line = unicode(line, "utf-8", errors="ignore")
 		if line.find("error") != -1:
@@ -45,11 +224,510 @@ def transcode(path):
 		if line.find("warning") != -1:
 			logging.debug(u"ffmpeg warning detected: {error_message}".format(error_message=line))
 			warnings += 1
+		if (error_limit is not None) and (errors + warnings >= error_limit):
+			logging.debug("ffmpeg error limit ({error_limit:,d}) reached, abandoning transcode".format(error_limit=error_limit))
+			break
 	return (errors + warnings)
 
 
+def checksum_and_transcode(path, strong_algorithm=None, error_limit=None, limiter=None):
+	"""
+	Read the media file at path exactly once, computing its checksum and simultaneously
+	piping the same data into ffmpeg's stdin to transcode it.  Returns a tuple of the
+	Checksum and the number of transcoding problems encountered.
+	"""
+	proc = start_tool([FFMPEG, "-v", "verbose", "-i", "pipe:0", "-f", "null", "-"], stderr=subprocess.STDOUT, stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True, cwd="/", env=dict())
+	# ffmpeg's output must be drained while we are feeding it, or both processes could block.
+	problems = []
+
+	def drain():
+		problems.append(count_transcode_problems(proc.stdout, error_limit))
+		if (error_limit is not None) and (problems[0] >= error_limit):
+			proc.kill()
+	reader = threading.Thread(target=drain)
+	reader.daemon = True
+	reader.start()
+
+	c = Checksum(strong_algorithm)
+	feeding = True
+	try:
+		with open(path, "rb") as f:
+			while True:
+				data = f.read(CHECKSUM_BUFFER_SIZE)
+				if not data:
+					break
+				if limiter is not None:
+					limiter.wait(len(data))
+				c.update(data)
+				if feeding:
+					try:
+						proc.stdin.write(data)
+					except IOError, e:
+						if e.errno != errno.EPIPE:
+							raise
+						# ffmpeg has given up on the file; finish the checksum on our own.
+						feeding = False
+	finally:
+		try:
+			proc.stdin.close()
+		except IOError, e:
+			if e.errno != errno.EPIPE:
+				raise
+		proc.wait()
+		reader.join()
+	return (c, problems[0])
+
+
+def resumable(m, strong_algorithm):
+	"""
+	Return whether the checksum of m can be computed chunk by chunk (and so paused at a
+	deadline and resumed by a later run), which is the case for media files of more than one
+	chunk when no (unresumable) strong checksum is required.
+	"""
+	return (strong_algorithm is None) and (m.size is not None) and (m.size > CHUNK_SIZE)
+
+
+def verify(m, checksum_threshold, strong_algorithm=None, single_read="auto", deadline=None, transcode_mode="full", error_limit=None, limiter=None):
+	"""
+	Verify the media file m (if its checksum is due), updating it with the results.  A media
+	file that cannot be read (because of a bad sector, for example) is recorded as having a
+	transcoding error, and is not read again until its checksum next falls due; one that no
+	longer exists is left unchanged.  A ToolError is raised if ffmpeg (or ffprobe) cannot be run.
+	"""
+	# If the media file vanishes part way through its verification, none of it is saved.
+	previous = dict(m.__dict__, measurements=list(m.measurements))
+	try:
+		st = os.stat(m.path)
+	except OSError, e:
+		logging.warning(u"unable to verify media ({error}): {path}".format(error=e, path=m.path))
+		return m
+	m.size = st.st_size
+	m.device = st.st_dev
+	m.inode = st.st_ino
+	if limiter is not None:
+		limiter = limiter.device(st.st_dev)
+	if (checksum_threshold is not None) and (m.size_updated or (m.checksum_timestamp is None) or (m.checksum_timestamp < checksum_threshold)):
+		try:
+			# When we expect the checksum to change (and therefore a transcode to be required),
+			# read the file once and feed both the checksum and ffmpeg from that single read.
+			# The time taken by each step is recorded so that future verifications can be scheduled
+			# to fit within --maximum-run-time.
+			transcode_errors = None
+			started = time.time()
+			# New media files are only sampled in quick transcode mode (which requires seeking, so
+			# precludes a single read).
+			sample = (transcode_mode == "quick") and (m.checksum is None)
+			single = (not sample) and ((single_read == "always") or ((single_read == "auto") and (m.size_updated or (m.checksum is None))))
+			# A single read can't be paused, so when we have a deadline to meet, a resumable
+			# (chunked) checksum takes precedence over it.
+			if resumable(m, strong_algorithm) and ((deadline is not None) or (not single)):
+				# Resume a previously paused checksum, unless the file has changed since.
+				offset = 0
+				crc = 0
+				if (m.resume_offset is not None) and (not m.size_updated) and (m.resume_mtime == st.st_mtime):
+					offset = m.resume_offset
+					crc = m.resume_crc
+				(c, m.chunks, complete) = checksum_chunks(m.path, offset, crc, deadline, limiter)
+				m.measure("checksum", c.length - offset, time.time() - started)
+				if not complete:
+					logging.info(u"checksum({path}): paused at {offset:,d} of {size:,d} bytes".format(offset=c.length, path=m.path, size=m.size))
+					m.resume_crc = c.crc & 0xffffffff
+					m.resume_mtime = st.st_mtime
+					m.resume_offset = c.length
+					return m
+				m.resume_crc = None
+				m.resume_mtime = None
+				m.resume_offset = None
+			elif single:
+				(c, transcode_errors) = checksum_and_transcode(m.path, strong_algorithm, error_limit, limiter)
+			else:
+				c = checksum(m.path, strong_algorithm, limiter)
+				m.measure("checksum", c.length, time.time() - started)
+			m.checksum = c.hexdigest()
+			if strong_algorithm is not None:
+				m.strong_checksum = c.strong_hexdigest()
+			m.checksum_timestamp = time.time()
+			if transcode_errors is not None:
+				m.transcode_errors = transcode_errors
+				m.transcode_timestamp = time.time()
+				m.measure("transcode", c.length, m.transcode_timestamp - started)
+			elif (m.checksum_updated):
+				# A sample is only trusted if it is clean; otherwise (or if the file could not be
+				# sampled) we escalate to a full transcode.
+				if sample:
+					transcode_errors = sample_transcode(m.path, error_limit, limiter)
+					if transcode_errors is None:
+						logging.debug(u"unable to sample media (duration unknown), transcoding in full: {path}".format(path=m.path))
+					elif transcode_errors > 0:
+						logging.info(u"sampled transcode found {transcode_errors:,d} problems, transcoding in full: {path}".format(path=m.path, transcode_errors=transcode_errors))
+				if (transcode_errors is None) or (transcode_errors > 0):
+					started = time.time()
+					transcode_errors = transcode(m.path, error_limit, limiter)
+					m.measure("transcode", m.size, time.time() - started)
+				m.transcode_errors = transcode_errors
+				m.transcode_timestamp = time.time()
+		except EnvironmentError, e:
+			if e.errno == errno.ENOENT:
+				logging.warning(u"unable to verify media ({error}): {path}".format(error=e, path=m.path))
+				m.__dict__.update(previous)
+				return m
+			logging.error(u"unable to read media ({error}): {path}".format(error=e, path=m.path))
+			m.transcode_errors = max(m.transcode_errors or 0, 1)
+			m.transcode_timestamp = time.time()
+			m.checksum_timestamp = m.transcode_timestamp
+	return m
+
+
+def verification_operations(m, single_read, resumable, transcode_mode):
+	"""
+	Return a list of (operation, bytes) tuples for the operations that verifying m (if its
+	checksum is due) is expected to take (see verify()): a "transcode" if it will be read once
+	by ffmpeg, or otherwise a "checksum" followed, if m has never been checksummed, by a
+	"transcode" (in full, as a sample in quick transcode mode may escalate to one).  A
+	resumable checksum is only expected to read one chunk in this run, and is only followed
+	by a transcode if that completes it.
+	"""
+	if resumable:
+		remaining = m.size - (m.resume_offset or 0)
+		operations = [("checksum", min(remaining, CHUNK_SIZE))]
+		if remaining > CHUNK_SIZE:
+			return operations
+	elif ((transcode_mode != "quick") or (m.checksum is not None)) and ((single_read == "always") or ((single_read == "auto") and (m.checksum is None))):
+		return [("transcode", m.size)]
+	else:
+		operations = [("checksum", m.size)]
+	if m.checksum is None:
+		operations.append(("transcode", m.size))
+	return operations
+
+
+def compile_globs(globs):
+	"""
+	Compile a list of shell glob patterns into a single matcher function, which returns a
+	true value for any file name that matches at least one of the patterns.
+	"""
+	return re.compile("|".join("(?:{pattern})".format(pattern=fnmatch.translate(glob)) for glob in globs)).match
+
+
+def list_directory(directory, matcher):
+	"""
+	List a directory, returning a tuple of the paths of its subdirectories and a list of
+	(path, size, device, inode) tuples for the media files within it (all but the path are
+	None for broken links).  Uses scandir (when available) so that only media files, not every
+	entry, need to be stat'ed.
+	"""
+	subdirectories = []
+	media = []
+	if scandir is not None:
+		for entry in scandir(directory):
+			if entry.is_dir():
+				subdirectories.append(entry.path)
+			elif matcher(entry.name):
+				try:
+					st = entry.stat()
+					media.append((entry.path, st.st_size, st.st_dev, st.st_ino))
+				except OSError:
+					media.append((entry.path, None, None, None))
+	else:
+		for name in os.listdir(directory):
+			file = os.path.join(directory, name)
+			try:
+				st = os.stat(file)
+			except OSError:
+				st = None
+			if (st is not None) and stat.S_ISDIR(st.st_mode):
+				subdirectories.append(file)
+			elif matcher(name):
+				if st is None:
+					media.append((file, None, None, None))
+				else:
+					media.append((file, st.st_size, st.st_dev, st.st_ino))
+	return (subdirectories, media)
+
+
+def find_media(root, matcher, index=None, scanned=None, failed=None):
+	"""
+	Yield a (path, size, device, inode) tuple for every media file under root (following
+	symbolic links).
+	If an index of a previous scan is given (see MediaDB.load_directories()), the contents
+	of any directory whose mtime and inode are unchanged since that scan are not listed at
+	all: its media files are already in the database and its subdirectories are taken from
+	the index.  Every directory that is visited is recorded in scanned, in the same format
+	as the index (but with an mtime of None if it could change again without its mtime
+	changing, so that it is listed again by the next scan).  If failed is given, every directory that could not be listed (so whose
+	contents, and subdirectories, are unknown) is added to it.
+	"""
+	if index is None:
+		index = {}
+	if scanned is None:
+		scanned = {}
+	directories = [root]
+	while directories:
+		directory = directories.pop()
+		try:
+			st = os.stat(directory)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				logging.warning("unable to stat directory {directory}: {error}".format(directory=directory, error=e))
+				if failed is not None:
+					failed.add(unicode(directory, "utf-8"))
+			continue
+		path = unicode(directory, "utf-8")
+		mtime = st.st_mtime
+		previous = index.get(path)
+		if (previous is not None) and (previous[0] == st.st_mtime) and (previous[1] == st.st_ino):
+			subdirectories = previous[2]
+			directories.extend(subdirectory.encode("utf-8") for subdirectory in subdirectories)
+		else:
+			started = time.time()
+			try:
+				(listed, media) = list_directory(directory, matcher)
+			except OSError, e:
+				if e.errno != errno.ENOENT:
+					logging.warning("unable to list directory {directory}: {error}".format(directory=directory, error=e))
+					if failed is not None:
+						failed.add(path)
+				continue
+			subdirectories = [unicode(subdirectory, "utf-8") for subdirectory in listed]
+			directories.extend(listed)
+			for (file, size, device, inode) in media:
+				yield (unicode(file, "utf-8"), size, device, inode)
+			# A directory that was modified within an mtime tick of being listed (or while it
+			# was being listed) may since have been modified again within the same tick, which
+			# would leave its mtime unchanged (the "racy clean" problem), so its mtime is not
+			# indexed.
+			try:
+				if (st.st_mtime >= started - MTIME_GRANULARITY) or (os.stat(directory).st_mtime != st.st_mtime):
+					mtime = None
+			except OSError:
+				mtime = None
+		scanned[path] = (mtime, st.st_ino, subdirectories)
+
+
+def scan_roots(roots, matcher, index, scanned, found, failed=None):
+	"""
+	Walk every root concurrently (on one thread per root) and yield a (path, size, device,
+	inode) tuple for every media file found, for consumption by a single database writer.  The directories
+	visited under each root are recorded in scanned[root], and the number of media files
+	found under each root is counted in found[root].  Directories that could not be listed
+	are added to failed (see find_media()).
+	"""
+	results = Queue.Queue(maxsize=64)
+
+	def walk(root):
+		try:
+			chunk = []
+			for media in find_media(root, matcher, index, scanned[root], failed):
+				chunk.append(media)
+				if len(chunk) >= SCAN_CHUNK_SIZE:
+					results.put((root, chunk, None))
+					chunk = []
+			results.put((root, chunk, None))
+			results.put((root, None, None))
+		except Exception:
+			results.put((root, None, sys.exc_info()))
+
+	for root in roots:
+		scanned[root] = {}
+		found[root] = 0
+		walker = threading.Thread(target=walk, args=(root,), name="scanner-{root}".format(root=root))
+		walker.daemon = True
+		walker.start()
+
+	running = len(roots)
+	while running > 0:
+		try:
+			(root, chunk, exc_info) = results.get(True, 1)
+		except Queue.Empty:
+			# Poll with a timeout so that the scan remains interruptible.
+			continue
+		if exc_info is not None:
+			raise exc_info[0], exc_info[1], exc_info[2]
+		if chunk is None:
+			running -= 1
+			continue
+		found[root] += len(chunk)
+		for media in chunk:
+			yield media
+
+
+def discover_media(db, directories, globs, full_scan, present=None, unchanged=None, statistics=None, failed=None):
+	"""
+	Add all new media files in the listed directories to the database.  Unless a full scan is
+	requested, directories that have not changed since the previous scan are not listed again.
+	Returns a dictionary mapping each root to the directories that were visited within it.  If
+	present is given, the path of every media file that was found is added to it; if unchanged
+	is given, the path of every directory that was not listed again is added to it; if failed
+	is given, the path of every directory that could not be listed is added to it.  If
+	statistics are given, the time spent walking the directories and inserting the media files
+	that were found into the database is recorded in them.
+	"""
+	started = time.time()
+	if full_scan:
+		index = {}
+	else:
+		index = db.load_directories(globs)
+	roots = sorted(set(directories))
+	scanned = {}
+	found = {}
+	media = scan_roots(roots, compile_globs(globs), index, scanned, found, failed)
+	if present is not None:
+		media = record_present(media, present)
+	if statistics is not None:
+		media = statistics.timed("walk", media)
+	(new, known) = db.discover(media)
+	for root in roots:
+		db.save_directories(root, scanned[root])
+		logging.info("found {count:,d} media files within root: {root}".format(count=found[root], root=root))
+		if unchanged is not None:
+			for (path, (mtime, inode, subdirectories)) in scanned[root].iteritems():
+				previous = index.get(path)
+				if (previous is not None) and (mtime is not None) and (previous[0] == mtime) and (previous[1] == inode):
+					unchanged.add(path)
+	db.save_directory_globs(globs)
+	logging.info("discovered {new:,d} new media files ({known:,d} already known)".format(known=known, new=new))
+	if statistics is not None:
+		# Whatever time was not spent walking was spent inserting into the database.
+		statistics.add_phase("discovery_insert", time.time() - started - statistics.phases.get("walk", 0.0))
+		statistics.count("found", sum(found.itervalues()))
+		statistics.count("new", new)
+	return scanned
+
+
+def record_present(media, present):
+	for (path, size, device, inode) in media:
+		# Broken links are found, but are not present.
+		if size is not None:
+			present.add(path)
+		yield (path, size, device, inode)
+
+
+def prune_media(db, directories, globs, present, unchanged, failed):
+	"""
+	Remove every media file that no longer exists from the database, given the media files
+	that are present, the directories that were not listed again and the directories that
+	could not be listed by the discovery scan (see discover_media()).  The media files within
+	the scanned directories are pruned by set difference, without touching the disk; only
+	those that the scan could not have found (because they are outside of every scanned
+	directory, within a directory that could not be listed or no longer match the media
+	globs) are stat'ed.  Every removal is made in a single transaction.
+	"""
+	prefixes = tuple(os.path.join(unicode(directory, "utf-8"), u"") for directory in set(directories))
+	unlisted = tuple(os.path.join(directory, u"") for directory in failed)
+	matcher = compile_globs(globs)
+	missing = []
+	for (path,) in db.iterate_paths():
+		if (path in present) or (os.path.dirname(path) in unchanged):
+			continue
+		if ((not path.startswith(prefixes)) or path.startswith(unlisted) or (not matcher(os.path.basename(path)))) and os.path.isfile(path):
+			continue
+		missing.append(path)
+	with db.transaction():
+		db.remove_paths(missing)
+	logging.info("pruned {count:,d} media files that no longer exist".format(count=len(missing)))
+	return len(missing)
+
+
+def verification_thresholds(checksum_interval, divide_verification_evenly):
+	"""
+	Return a tuple of the checksum threshold (the time before which a media file must have
+	last been verified for it to be pending verification) and, if verification is being
+	divided evenly over the checksum interval, the partition that is currently being verified.
+	"""
+	current_partition = None
+	checksum_threshold = None
+	if checksum_interval > 0:
+		if divide_verification_evenly:
+			# If we are attempting to divide our workload in order to distribute it more evenly,
+			# calculate which partition we are currently working on, using the number of days
+			# since the UNIX epoch as our counter.
+			current_partition = (datetime.datetime.today() - datetime.datetime.utcfromtimestamp(0)).days % checksum_interval
+			# We are partitioning the data, so calculate our checksum_threshold as 00:00 today (the further restriction of the current partition will
+			# stop us from verifying more media files than we mean to).
+			checksum_threshold = (datetime.datetime.combine(datetime.date.today(), datetime.time.min) - datetime.datetime.fromtimestamp(0)).total_seconds()
+		else:
+			# We are not partitioning the data, so just calculate the checksum_threshold as exactly checksum_interval days ago.
+			checksum_threshold = (datetime.datetime.now() - datetime.timedelta(days=checksum_interval) - datetime.datetime.fromtimestamp(0)).total_seconds()
+	return (checksum_threshold, current_partition)
+
+
+def report(db, arguments):
+	"""
+	Print the requested report.  Every report is computed by a single query (so the database
+	is read in a single read transaction, which does not block a concurrent verifier when the
+	database is in WAL mode) and is printed as it is read, rather than being loaded in full.
+	"""
+	db.cnx.execute("PRAGMA query_only = ON")
+	if arguments.report is not None:
+		columns = ["errors", "path"]
+		rows = ((m.transcode_errors, m.path) for m in db.iterate_errored(arguments.report))
+	elif arguments.aggregate_report == "checksum-changes":
+		since = arguments.since
+		if since is None:
+			since = time.time() - (arguments.checksum_interval * 86400)
+		(columns, rows) = db.report_checksum_changes(since)
+	elif arguments.aggregate_report == "error-histogram":
+		(columns, rows) = db.report_error_histogram()
+	elif arguments.aggregate_report == "overdue":
+		(columns, rows) = db.report_overdue(verification_thresholds(arguments.checksum_interval, False)[0], arguments.checksum_interval)
+	elif arguments.aggregate_report == "verification-age":
+		(columns, rows) = db.report_verification_age(time.time())
+	write_report(sys.stdout, columns, rows, arguments.report_format)
+
+
+def write_report(output, columns, rows, format):
+	"""
+	Write the rows of a report to output as they are read: as "text" (aligned columns), as
+	"csv" (with a header row), or as "json" (one JSON object per row, i.e. JSON Lines).
+	"""
+	if format == "csv":
+		writer = csv.writer(output)
+		writer.writerow(columns)
+		for row in rows:
+			writer.writerow([value.encode("utf-8") if isinstance(value, unicode) else value for value in row])
+	elif format == "json":
+		for row in rows:
+			output.write(json.dumps(collections.OrderedDict(zip(columns, row))) + "\n")
+	elif columns == ["errors", "path"]:
+		for (errors, path) in rows:
+			output.write(u"{errors:>3d} {path}\n".format(errors=errors, path=path).encode("utf-8"))
+	else:
+		output.write(" ".join("{column:>16s}".format(column=column) for column in columns) + "\n")
+		for row in rows:
+			output.write(" ".join(("{value:>16,d}" if isinstance(value, (int, long)) else "{value:>16s}").format(value=value) for value in row) + "\n")
+
+
+def report_since(value):
+	try:
+		return (datetime.datetime.strptime(value, "%Y-%m-%d") - datetime.datetime.fromtimestamp(0)).total_seconds()
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid date (expected YYYY-MM-DD): {value}".format(value=value))
+
+
+def byte_rate(value):
+	multiplier = 1
+	suffix = value[-1:].upper()
+	if suffix in ("K", "M", "G"):
+		multiplier = 1024 ** ("KMG".index(suffix) + 1)
+		value = value[:-1]
+	try:
+		rate = int(float(value) * multiplier)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid rate: {value}".format(value=value))
+	if rate < 1:
+		raise argparse.ArgumentTypeError("rate must be at least 1 byte per second")
+	return rate
+
+
 def configure():
 	parser = argparse.ArgumentParser(description="Check all media files under the given directory for validity.")
+	parser.add_argument(
+		"-a", "--aggregate-report",
+		choices=["checksum-changes", "error-histogram", "overdue", "verification-age"],
+		default=None,
+		help="display a summary report of the database: the number of media files whose checksums have changed on each day (since --since), the number of media files with each number of transcoding errors, the number of overdue media files in each partition of the checksum interval, or the number of media files by how long ago they were last verified (each with their total size)",
+		metavar="REPORT"
+	)
 	parser.add_argument(
 		"-c", "--checksum-interval",
 		default=14,
@@ -68,6 +746,32 @@ def configure():
 		action="store_true",
 		help="verify a maximum of 1/<DAYS> of the media files per day (where DAYS is the checksum interval, default: verify all pending files)"
 	)
+	parser.add_argument(
+		"-f", "--full-scan",
+		action="store_true",
+		help="list the contents of every directory (default: skip listing directories whose mtime and inode have not changed since the previous scan)"
+	)
+	parser.add_argument(
+		"-j", "--jobs",
+		default=1,
+		help="the number of media files to verify concurrently (default: %(default)s)",
+		metavar="NJOBS",
+		type=int
+	)
+	parser.add_argument(
+		"-J", "--jobs-per-device",
+		default=0,
+		help="the maximum number of media files on the same device (st_dev) to verify concurrently, to keep parallel readers from seeking against each other on a single disk (default: no per-device limit, as a library is usually on one device, such as a RAID array or network mount, that serves concurrent readers well)",
+		metavar="NJOBS",
+		type=int
+	)
+	parser.add_argument(
+		"--ionice",
+		choices=["best-effort", "idle"],
+		default=None,
+		help="the I/O scheduling class to run %(prog)s (and the processes that it starts) in: \"best-effort\", or \"idle\" to only read from disk when no other process is doing so (default: unchanged)",
+		metavar="CLASS"
+	)
 	parser.add_argument(
 		"-m", "--media-glob",
 		action="append",
@@ -82,11 +786,38 @@ def configure():
 		metavar="NVERIFIES",
 		type=int
 	)
+	parser.add_argument(
+		"--max-io-latency",
+		default=None,
+		help="slow down reads from any device whose average I/O latency (from /proc/diskstats) exceeds MSECS milliseconds, until it recovers; requires --max-read-rate (default: no adaptive slowdown)",
+		metavar="MSECS",
+		type=float
+	)
+	parser.add_argument(
+		"--max-read-rate",
+		default=None,
+		help="the maximum rate, in bytes per second (with an optional K, M or G suffix), at which all checksums and transcodes (together) read media files (default: unlimited)",
+		metavar="RATE",
+		type=byte_rate
+	)
+	parser.add_argument(
+		"--nice",
+		default=None,
+		help="the niceness increment to run %(prog)s (and the processes that it starts) with (default: unchanged)",
+		metavar="N",
+		type=int
+	)
 	parser.add_argument(
 		"-p", "--prune",
 		action="store_true",
 		help="prune files that no longer exist out of the database (default: leave files that no longer exist in the database)"
 	)
+	parser.add_argument(
+		"--prometheus-textfile",
+		default=None,
+		help="at the end of the run, write its metrics to PATH in the Prometheus (node exporter textfile collector) format",
+		metavar="PATH"
+	)
 	parser.add_argument(
 		"-r", "--report",
 		default=None,
@@ -94,6 +825,61 @@ def configure():
 		metavar="NERR",
 		type=int
 	)
+	parser.add_argument(
+		"--report-format",
+		choices=["csv", "json", "text"],
+		default="text",
+		help="the format in which to display reports: \"csv\", \"json\" (one JSON object per line) or \"text\" (default: %(default)s)",
+		metavar="FORMAT"
+	)
+	parser.add_argument(
+		"--since",
+		default=None,
+		help="the date (YYYY-MM-DD) from which the checksum-changes report counts changes (default: the start of the checksum interval)",
+		metavar="DATE",
+		type=report_since
+	)
+	parser.add_argument(
+		"--sqlite-cache-size",
+		default=65536,
+		help="the size of the SQLite page cache, in KiB (default: %(default)s)",
+		metavar="KIB",
+		type=int
+	)
+	parser.add_argument(
+		"--sqlite-journal-mode",
+		choices=["delete", "memory", "off", "persist", "truncate", "wal"],
+		default="wal",
+		help="the SQLite journal mode to use (default: %(default)s, which allows --report to run alongside a verification run without either blocking the other)",
+		metavar="MODE"
+	)
+	parser.add_argument(
+		"--sqlite-synchronous",
+		choices=["extra", "full", "normal", "off"],
+		default="normal",
+		help="how aggressively SQLite should sync the database to disk (default: %(default)s)",
+		metavar="MODE"
+	)
+	parser.add_argument(
+		"--stats-file",
+		default=None,
+		help="at the end of the run, write its statistics (per-phase timings, bytes read, files per second, queue depth and per-device read rates) to PATH as JSON",
+		metavar="PATH"
+	)
+	parser.add_argument(
+		"-S", "--single-read",
+		choices=["always", "auto", "never"],
+		default="auto",
+		help="read each media file only once, piping the data read for its checksum into ffmpeg, either \"always\", only when a transcode is expected (\"auto\": new or resized files), or \"never\" (default: %(default)s; note that ffmpeg cannot seek within piped input, so containers that require seeking should use \"never\")",
+		metavar="MODE"
+	)
+	parser.add_argument(
+		"-s", "--strong-checksum",
+		choices=sorted(hashlib.algorithms_available),
+		default=None,
+		help="also compute and store a stronger digest of each media file, using the given hash algorithm, in the same pass as its CRC32 checksum (default: CRC32 only)",
+		metavar="ALGORITHM"
+	)
 	parser.add_argument(
 		"-t", "--maximum-run-time",
 		default=None,
@@ -101,11 +887,30 @@ def configure():
 		metavar="SECS",
 		type=int
 	)
+	parser.add_argument(
+		"-e", "--transcode-error-limit",
+		default=None,
+		help="abandon transcoding a media file once ffmpeg has reported NERR problems with it (default: always transcode the whole media file)",
+		metavar="NERR",
+		type=int
+	)
+	parser.add_argument(
+		"-T", "--transcode-mode",
+		choices=["full", "quick"],
+		default="full",
+		help="how to transcode new media files: decode them in \"full\", or \"quick\"ly decode only their keyframes and {samples:d} {seconds:d}-second samples, escalating to a full decode if that finds problems (media files whose checksums have changed are always decoded in full) (default: %(default)s)".format(samples=TRANSCODE_SAMPLES, seconds=TRANSCODE_SAMPLE_SECONDS),
+		metavar="MODE"
+	)
 	parser.add_argument(
 		"-v", "--verbose",
 		action="count",
 		help="increase the verbosity of the %(prog)s log output (argument can be given multiple times, to a maximum of -vv)"
 	)
+	parser.add_argument(
+		"-w", "--watch",
+		action="store_true",
+		help="after the initial scan, keep running and watch the directories (via inotify) for media files being written, moved or deleted, verifying new media files immediately (default: exit once all pending files are verified)"
+	)
 	parser.add_argument(
 		"--version",
 		action="version",
@@ -128,19 +933,50 @@ def configure():
 	logging.basicConfig(datefmt="%d %b %Y %H:%M:%S", format="%(asctime)s %(levelname)-8s %(message)s", level=loglevel)
 	logging.debug("arguments: %s", unicode(arguments))
 
+	if arguments.jobs < 1:
+		parser.error("argument -j/--jobs: must be at least 1")
+	if arguments.jobs_per_device < 0:
+		parser.error("argument -J/--jobs-per-device: must not be negative")
+	if (arguments.transcode_error_limit is not None) and (arguments.transcode_error_limit < 1):
+		parser.error("argument -e/--transcode-error-limit: must be at least 1")
+	if (arguments.aggregate_report is not None) and (arguments.report is not None):
+		parser.error("argument -a/--aggregate-report: not allowed with argument -r/--report")
+	if (arguments.aggregate_report == "overdue") and (arguments.checksum_interval <= 0):
+		parser.error("argument -a/--aggregate-report: overdue requires a checksum interval")
+	if (arguments.aggregate_report == "checksum-changes") and (arguments.since is None) and (arguments.checksum_interval <= 0):
+		parser.error("argument -a/--aggregate-report: checksum-changes requires either --since or a checksum interval")
+	if (arguments.max_io_latency is not None) and (arguments.max_read_rate is None):
+		parser.error("argument --max-io-latency: requires --max-read-rate")
+	if arguments.watch and not arguments.directories:
+		parser.error("argument -w/--watch: at least one DIR is required")
+	# Discovery, its index of unchanged directories and pruning all compare the paths that
+	# are walked from each root as strings, so each root must be walked in a single form.
+	arguments.directories = [os.path.normpath(directory) for directory in arguments.directories]
+
 	return arguments
 
 
 class MediaDB(object):
-	def __init__(self, path):
+	def __init__(self, path, journal_mode=None, synchronous=None, cache_size=None):
+		self.cache_size = cache_size
 		self.cnx = None
+		self.journal_mode = journal_mode
 		self.path = path
+		self.synchronous = synchronous
+		self.transaction_depth = 0
 		self.connect()
 		if self.connected():
 			self.ensure_schema()
 
+	def add_column(self, table, column, definition):
+		columns = [row["name"] for row in self.cnx.execute("PRAGMA table_info({table})".format(table=table))]
+		if column not in columns:
+			self.cnx.execute("ALTER TABLE {table} ADD COLUMN {column} {definition}".format(column=column, definition=definition, table=table))
+
 	def commit(self):
-		self.cnx.commit()
+		# Within a transaction() block, changes are only committed when the block exits.
+		if self.transaction_depth == 0:
+			self.cnx.commit()
 
 	def connect(self):
 		if self.connected():
@@ -149,6 +985,17 @@ class MediaDB(object):
 		try:
 			self.cnx = sqlite3.connect(self.path)
 			self.cnx.row_factory = sqlite3.Row
+			if self.journal_mode is not None:
+				# The journal mode is persistent, so (once set) it also applies to other connections
+				# (such as a --report run alongside a running verifier).
+				mode = self.cnx.execute("PRAGMA journal_mode = {mode}".format(mode=self.journal_mode)).fetchone()[0]
+				if mode.lower() != self.journal_mode.lower():
+					logging.warning("sqlite journal mode {journal_mode} is unavailable, using {mode}".format(journal_mode=self.journal_mode, mode=mode))
+			if self.synchronous is not None:
+				self.cnx.execute("PRAGMA synchronous = {synchronous}".format(synchronous=self.synchronous))
+			if self.cache_size is not None:
+				# A negative cache size is measured in KiB, rather than in pages.
+				self.cnx.execute("PRAGMA cache_size = {cache_size:d}".format(cache_size=-self.cache_size))
 		except sqlite3.Error, e:
 			logging.error("sqlite error: {error}".format(error=e.args[0]))
 			self.disconnect()
@@ -164,47 +1011,384 @@ class MediaDB(object):
 			self.cnx.close()
 			self.cnx = None
 
-	def ensure_row(self, path):
-		cur = self.cnx.cursor()
-		cur.execute("SELECT ROWID FROM media WHERE path = ?", (path,))
-		row = cur.fetchone()
-		if row is None:
-			m = MediaRow(self)
-			m.path = path
-			m.save()
+	def discover(self, paths):
+		"""
+		Ensure that every (path, size, device, inode) tuple in the given iterable has a row in
+		the media table.  New rows are inserted in transactions of DISCOVERY_BATCH_SIZE rows (rather than
+		one transaction per row).  Returns a (new, known) tuple counting the paths that were
+		inserted and the paths that were already present.
+		"""
+		new = 0
+		known = 0
+		batch = []
+		for media in paths:
+			batch.append(media)
+			if len(batch) >= DISCOVERY_BATCH_SIZE:
+				inserted = self.insert_paths(batch)
+				new += inserted
+				known += len(batch) - inserted
+				batch = []
+		if batch:
+			inserted = self.insert_paths(batch)
+			new += inserted
+			known += len(batch) - inserted
+		return (new, known)
 
 	def ensure_schema(self):
+		"""
+		Bring the database schema up to SCHEMA_VERSION (recorded in the database's user_version)
+		by applying each of the schema_v<N> migrations that it has not yet had applied.
+		"""
+		version = self.cnx.execute("PRAGMA user_version").fetchone()[0]
+		if version > SCHEMA_VERSION:
+			logging.error("database schema version {version:d} is newer than the newest supported version ({supported:d})".format(supported=SCHEMA_VERSION, version=version))
+			self.disconnect()
+			return
+		with self.transaction():
+			for version in range(version + 1, SCHEMA_VERSION + 1):
+				logging.info("migrating database schema to version {version:d}".format(version=version))
+				getattr(self, "schema_v{version:d}".format(version=version))()
+				self.cnx.execute("PRAGMA user_version = {version:d}".format(version=version))
+
+	# Databases created before the schema was versioned may already have had any of these
+	# changes made to them, so every migration must be idempotent.
+	def schema_v1(self):
 		self.cnx.execute("CREATE TABLE IF NOT EXISTS media (checksum character(8), checksum_timestamp int, transcode_errors int, transcode_timestamp int, path text, size int)")
 		self.cnx.execute("CREATE UNIQUE INDEX IF NOT EXISTS media_path_idx ON media (path)")
 
-	def fetch_pending(self, checksum_threshold, current_partition, partition_count):
-		cur = self.cnx.cursor()
-		cur.execute("SELECT ROWID, * FROM media WHERE size IS NULL LIMIT 1")
-		row = cur.fetchone()
+	def schema_v2(self):
+		self.add_column("media", "strong_checksum", "text")
+
+	def schema_v3(self):
+		self.cnx.execute("CREATE TABLE IF NOT EXISTS directories (path text, parent text, mtime real, inode int)")
+		self.cnx.execute("CREATE UNIQUE INDEX IF NOT EXISTS directories_path_idx ON directories (path)")
+		self.cnx.execute("CREATE TABLE IF NOT EXISTS settings (name text PRIMARY KEY, value text)")
+
+	def schema_v4(self):
+		self.add_column("media", "verification_partition", "int")
+		self.cnx.execute("CREATE INDEX IF NOT EXISTS media_checksum_timestamp_idx ON media (checksum_timestamp)")
+		self.cnx.execute("CREATE INDEX IF NOT EXISTS media_partition_idx ON media (verification_partition, checksum_timestamp)")
+		self.cnx.execute("CREATE INDEX IF NOT EXISTS media_unsized_idx ON media (size) WHERE size IS NULL")
+
+	def schema_v5(self):
+		self.add_column("media", "checksum_duration", "real")
+		self.add_column("media", "transcode_duration", "real")
+		self.cnx.execute("CREATE TABLE IF NOT EXISTS throughput (device int, operation text, bytes real, seconds real, PRIMARY KEY (device, operation))")
+
+	def schema_v6(self):
+		self.add_column("media", "resume_crc", "int")
+		self.add_column("media", "resume_mtime", "real")
+		self.add_column("media", "resume_offset", "int")
+		self.cnx.execute("CREATE TABLE IF NOT EXISTS chunks (media int, chunk int, crc character(8), PRIMARY KEY (media, chunk))")
+		self.cnx.execute("CREATE TRIGGER IF NOT EXISTS media_chunks_delete AFTER DELETE ON media BEGIN DELETE FROM chunks WHERE media = OLD.ROWID; END")
+
+	def schema_v7(self):
+		self.add_column("media", "device", "int")
+		self.add_column("media", "inode", "int")
+		self.cnx.execute("CREATE INDEX IF NOT EXISTS media_identity_idx ON media (device, inode)")
+
+	def schema_v8(self):
+		self.add_column("media", "checksum_changed_timestamp", "real")
+		self.cnx.execute("CREATE INDEX IF NOT EXISTS media_checksum_changed_idx ON media (checksum_changed_timestamp) WHERE checksum_changed_timestamp IS NOT NULL")
+
+	@contextlib.contextmanager
+	def transaction(self):
+		"""
+		Group all of the changes made within a with block into a single transaction, which is
+		committed when the outermost block exits (or rolled back if it raises an exception).
+		"""
+		self.transaction_depth += 1
+		try:
+			yield self
+		except:
+			self.transaction_depth -= 1
+			if self.transaction_depth == 0:
+				self.cnx.rollback()
+			raise
+		self.transaction_depth -= 1
+		self.commit()
+
+	def fetch_alias(self, m, device, inode, size, verified_since):
+		"""
+		Return the most recently verified other path (i.e. hard link, or path through a symbolic
+		link) to the physical file that m refers to, if it was verified at or after verified_since
+		and had the given size when it was verified.  Returns None if there is no such alias.
+		"""
+		row = self.cnx.execute("SELECT ROWID, * FROM media WHERE (device = ?) AND (inode = ?) AND (ROWID != ?) AND (size = ?) AND (checksum_timestamp >= ?) AND (transcode_timestamp IS NOT NULL) AND (resume_offset IS NULL) ORDER BY checksum_timestamp DESC LIMIT 1", (device, inode, m.id, size, verified_since)).fetchone()
+		if row is None:
+			return None
+		return MediaRow(self, row)
 
-		if (row is None) and (checksum_threshold is not None):
-			if current_partition is not None:
-				cur.execute("SELECT ROWID, * FROM media WHERE ((checksum_timestamp IS NULL) OR (checksum_timestamp < ?)) AND ((ROWID % ?) = ?) ORDER BY checksum_timestamp ASC LIMIT 1", (checksum_threshold,partition_count,current_partition,))
-				row = cur.fetchone()
+	def fetch_path(self, path):
+		row = self.cnx.execute("SELECT ROWID, * FROM media WHERE path = ?", (path,)).fetchone()
+		if row is None:
+			return None
+		return MediaRow(self, row)
+
+	def earliest_verification(self, since):
+		"""
+		Return the checksum_timestamp of the media file that was least recently verified at or
+		after since, or None if no media file has been verified since then.
+		"""
+		return self.cnx.execute("SELECT MIN(checksum_timestamp) FROM media WHERE checksum_timestamp >= ?", (since,)).fetchone()[0]
+
+	def iterate_pending(self, checksum_threshold, current_partition, partition_count):
+		"""
+		Yield every media file that is pending verification, in the order in which they should
+		be verified: media files of unknown size, then media files that have never been
+		checksummed (whatever their partition, so that new media files are verified as soon as
+		they are discovered), then media files whose checksums are the most overdue (within the
+		current partition, if verification is divided evenly).  Rows are fetched
+		PENDING_BATCH_SIZE at a time by indexed (keyset) queries, so the cost of finding the
+		next pending media file does not grow with the size of the library.
+		"""
+		for m in self.paginate("(size IS NULL)", ()):
+			yield m
+		if checksum_threshold is None:
+			return
+		for m in self.paginate("(size IS NOT NULL) AND (checksum_timestamp IS NULL)", ()):
+			yield m
+
+		partition = ""
+		parameters = ()
+		if current_partition is not None:
+			self.update_partitions(partition_count)
+			partition = " AND (verification_partition = ?)"
+			parameters = (current_partition,)
+
+		last = None
+		while True:
+			if last is None:
+				rows = self.cnx.execute("SELECT ROWID, * FROM media WHERE (size IS NOT NULL) AND (checksum_timestamp < ?)" + partition + " ORDER BY checksum_timestamp, ROWID LIMIT ?", (checksum_threshold,) + parameters + (PENDING_BATCH_SIZE,)).fetchall()
 			else:
-				cur.execute("SELECT ROWID, * FROM media WHERE  (checksum_timestamp IS NULL) OR (checksum_timestamp < ?) ORDER BY checksum_timestamp ASC LIMIT 1", (checksum_threshold,))
-				row = cur.fetchone()
+				rows = self.cnx.execute("SELECT ROWID, * FROM media WHERE (size IS NOT NULL) AND (checksum_timestamp >= ?) AND (checksum_timestamp < ?) AND ((checksum_timestamp > ?) OR (ROWID > ?))" + partition + " ORDER BY checksum_timestamp, ROWID LIMIT ?", (last["checksum_timestamp"], checksum_threshold, last["checksum_timestamp"], last["ROWID"]) + parameters + (PENDING_BATCH_SIZE,)).fetchall()
+			for row in rows:
+				yield self.pending_row(row)
+			if len(rows) < PENDING_BATCH_SIZE:
+				break
+			last = rows[-1]
+
+	def paginate(self, condition, parameters):
+		last = -1
+		while True:
+			rows = self.cnx.execute("SELECT ROWID, * FROM media WHERE " + condition + " AND (ROWID > ?) ORDER BY ROWID LIMIT ?", parameters + (last, PENDING_BATCH_SIZE)).fetchall()
+			for row in rows:
+				yield self.pending_row(row)
+			if len(rows) < PENDING_BATCH_SIZE:
+				break
+			last = rows[-1]["ROWID"]
+
+	def pending_row(self, row):
+		media = MediaRow(self, row)
+		logging.debug("pending media found: {media}".format(media=str(media)))
+		return media
+
+	def update_partitions(self, partition_count):
+		"""
+		Store the partition (ROWID modulo the partition count) of every media file, so that
+		the media files within a partition can be found by index.  Only media files without a
+		partition are updated, unless the partition count has changed.
+		"""
+		if self.get_setting("partition_count") != unicode(partition_count):
+			self.cnx.execute("UPDATE media SET verification_partition = ROWID % ?", (partition_count,))
+			self.set_setting("partition_count", unicode(partition_count))
+		else:
+			self.cnx.execute("UPDATE media SET verification_partition = ROWID % ? WHERE verification_partition IS NULL", (partition_count,))
+		self.commit()
 
-		cur.close()
+	def insert_paths(self, batch):
+		total_changes = self.cnx.total_changes
+		self.cnx.executemany("INSERT OR IGNORE INTO media (path, size, device, inode) VALUES (?, ?, ?, ?)", batch)
+		self.commit()
+		return self.cnx.total_changes - total_changes
+
+	def get_setting(self, name):
+		row = self.cnx.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
 		if row is None:
 			return None
+		return row["value"]
+
+	def set_setting(self, name, value):
+		self.cnx.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+		self.commit()
+
+	def load_directories(self, globs):
+		"""
+		Load the index of directories that was saved by the previous scan, as a dictionary
+		mapping each directory path to a (mtime, inode, subdirectory paths) tuple.  The index
+		is discarded (i.e. an empty dictionary is returned) if the previous scan was looking
+		for media files with a different set of globs.
+		"""
+		index = {}
+		if self.get_setting("media_glob") != u"\n".join(sorted(set(globs))):
+			return index
+		children = {}
+		for row in self.cnx.execute("SELECT path, parent, mtime, inode FROM directories"):
+			index[row["path"]] = (row["mtime"], row["inode"], children.setdefault(row["path"], []))
+			if row["parent"] is not None:
+				children.setdefault(row["parent"], []).append(row["path"])
+		return index
+
+	def move_path(self, path, destination):
+		"""
+		Move a media file to destination (keeping everything known about it, and removing any
+		media file that it replaced).  Returns False if path is not in the media table.
+		"""
+		if self.cnx.execute("SELECT ROWID FROM media WHERE path = ?", (path,)).fetchone() is None:
+			return False
+		self.remove_path(destination)
+		self.cnx.execute("UPDATE media SET path = ? WHERE path = ?", (destination, path))
+		logging.info(u"moved({path}): {destination}".format(destination=destination, path=path))
+		self.commit()
+		return True
+
+	def move_tree(self, directory, destination):
+		"""
+		Move every media file (and indexed directory) within directory to within destination
+		(keeping everything known about them, and removing any that they replaced).
+		"""
+		prefix = os.path.join(directory, u"")
+		self.remove_tree(destination)
+		self.cnx.execute("UPDATE media SET path = ? || substr(path, ?) WHERE substr(path, 1, ?) = ?", (destination, len(directory) + 1, len(prefix), prefix))
+		self.cnx.execute("UPDATE directories SET path = ? || substr(path, ?), parent = ? || substr(parent, ?) WHERE substr(path, 1, ?) = ?", (destination, len(directory) + 1, destination, len(directory) + 1, len(prefix), prefix))
+		self.cnx.execute("UPDATE directories SET path = ?, parent = ? WHERE path = ?", (destination, os.path.dirname(destination), directory))
+		logging.info(u"moved({directory}): {destination}".format(destination=destination, directory=directory))
+		self.commit()
+
+	def remove_path(self, path):
+		if self.cnx.execute("DELETE FROM media WHERE path = ?", (path,)).rowcount > 0:
+			logging.warning(u"exists({path}): True => False".format(path=path))
+		self.commit()
+
+	def remove_paths(self, paths):
+		for path in paths:
+			logging.warning(u"exists({path}): True => False".format(path=path))
+		self.cnx.executemany("DELETE FROM media WHERE path = ?", ((path,) for path in paths))
+		self.commit()
+
+	def remove_tree(self, directory):
+		"""
+		Remove every media file (and indexed directory) within the given directory.
+		"""
+		prefix = os.path.join(directory, u"")
+		for row in self.cnx.execute("SELECT path FROM media WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)).fetchall():
+			logging.warning(u"exists({path}): True => False".format(path=row["path"]))
+		self.cnx.execute("DELETE FROM media WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+		self.cnx.execute("DELETE FROM directories WHERE (path = ?) OR (substr(path, 1, ?) = ?)", (directory, len(prefix), prefix))
+		self.commit()
+
+	def upsert(self, path, size, device=None, inode=None):
+		"""
+		Add a media file that has just been written to the media table or, if it is already
+		present, forget everything known about its previous contents so that it is verified
+		afresh (rather than reported as having changed).
+		"""
+		if self.cnx.execute("INSERT OR IGNORE INTO media (path, size, device, inode) VALUES (?, ?, ?, ?)", (path, size, device, inode)).rowcount > 0:
+			logging.debug(u"exists({path}): False => True".format(path=path))
 		else:
-			media = MediaRow(self, row)
-			logging.debug("pending media found: {media}".format(media=str(media)))
-			return media
+			self.cnx.execute("UPDATE media SET checksum=NULL, checksum_timestamp=NULL, device=?, inode=?, resume_crc=NULL, resume_mtime=NULL, resume_offset=NULL, strong_checksum=NULL, transcode_errors=NULL, transcode_timestamp=NULL, size=? WHERE path=?", (device, inode, size, path))
+			self.cnx.execute("DELETE FROM chunks WHERE media = (SELECT ROWID FROM media WHERE path = ?)", (path,))
+			logging.info(u"rewritten({path}): verifying afresh".format(path=path))
+		self.commit()
 
-	def iterate_all(self):
-		for row in self.cnx.execute("SELECT ROWID, * FROM media ORDER BY path"):
-			yield MediaRow(self, row)
+	def save_directories(self, root, scanned):
+		"""
+		Replace the saved index of the directories under root with the directories that were
+		visited by a scan of root (see find_media()).
+		"""
+		root = unicode(root, "utf-8")
+		prefix = os.path.join(root, u"")
+		parents = {}
+		for (path, (mtime, inode, subdirectories)) in scanned.iteritems():
+			for subdirectory in subdirectories:
+				parents[subdirectory] = path
+		self.cnx.execute("DELETE FROM directories WHERE (path = ?) OR (substr(path, 1, ?) = ?)", (root, len(prefix), prefix))
+		self.cnx.executemany("INSERT OR REPLACE INTO directories (path, parent, mtime, inode) VALUES (?, ?, ?, ?)", ((path, parents.get(path), mtime, inode) for (path, (mtime, inode, subdirectories)) in scanned.iteritems()))
+		self.commit()
+
+	def save_directory_globs(self, globs):
+		self.set_setting("media_glob", u"\n".join(sorted(set(globs))))
+
+	def load_throughput(self):
+		"""
+		Load the throughput that has been observed on each device, as a dictionary mapping
+		(device, operation) tuples to (bytes, seconds) tuples.
+		"""
+		return dict(((row["device"], row["operation"]), (row["bytes"], row["seconds"])) for row in self.cnx.execute("SELECT * FROM throughput"))
+
+	def record_throughput(self, throughput, device, operation, bytes, seconds):
+		"""
+		Add an observation of an operation on a device to the throughput dictionary (as returned
+		by load_throughput()) and save it.  Previous observations are decayed (by THROUGHPUT_DECAY
+		per observation), so that throughput tracks the current performance of each device.
+		"""
+		(total_bytes, total_seconds) = throughput.get((device, operation), (0.0, 0.0))
+		total_bytes = (total_bytes * THROUGHPUT_DECAY) + bytes
+		total_seconds = (total_seconds * THROUGHPUT_DECAY) + seconds
+		throughput[(device, operation)] = (total_bytes, total_seconds)
+		self.cnx.execute("INSERT OR REPLACE INTO throughput (device, operation, bytes, seconds) VALUES (?, ?, ?, ?)", (device, operation, total_bytes, total_seconds))
+		self.commit()
 
 	def iterate_errored(self, error_threshold):
-		for row in self.cnx.execute("SELECT ROWID, * FROM media WHERE transcode_errors >= ? ORDER BY path", (error_threshold,)):
-			yield MediaRow(self, row)
+		return self.iterate_records("WHERE transcode_errors >= ?", (error_threshold,))
+
+	def iterate_paths(self):
+		cur = self.cnx.cursor()
+		cur.row_factory = None
+		return cur.execute("SELECT path FROM media")
+
+	def iterate_records(self, condition, parameters):
+		"""
+		Yield a (read-only) MediaRecord, in path order, for every media file that matches the
+		given condition.  Use fetch_path() to get a MediaRow for any media file that is to be
+		updated.
+		"""
+		cur = self.cnx.cursor()
+		cur.row_factory = None
+		cur.execute("SELECT ROWID, " + ", ".join(MediaRecord._fields[1:]) + " FROM media " + condition + " ORDER BY path", parameters)
+		return itertools.imap(MediaRecord._make, cur)
+
+	# Each of the report_<name> methods computes a report (see write_report()) in a single
+	# aggregate query, and returns a tuple of its column names and an iterable of its rows.
+	def report_checksum_changes(self, since):
+		cur = self.query("SELECT date(checksum_changed_timestamp, 'unixepoch', 'localtime') AS day, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM media WHERE checksum_changed_timestamp >= ? GROUP BY day ORDER BY day", (since,))
+		return (["day", "files", "bytes"], cur)
+
+	def report_error_histogram(self):
+		cur = self.query("SELECT transcode_errors AS errors, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM media WHERE transcode_errors IS NOT NULL GROUP BY transcode_errors ORDER BY transcode_errors", ())
+		return (["errors", "files", "bytes"], cur)
+
+	def report_overdue(self, checksum_threshold, partition_count):
+		cur = self.query("SELECT ROWID % ? AS partition, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM media WHERE (checksum_timestamp IS NULL) OR (checksum_timestamp < ?) GROUP BY partition ORDER BY partition", (partition_count, checksum_threshold))
+		return (["partition", "files", "bytes"], cur)
+
+	def report_verification_age(self, now):
+		"""
+		Report the number of media files, and their total size, by how long ago they were last
+		verified (in the buckets given, in days, by REPORT_AGE_BUCKETS).
+		"""
+		labels = ["never"]
+		cases = ["WHEN checksum_timestamp IS NULL THEN 0"]
+		parameters = ()
+		previous = 0
+		for (i, days) in enumerate(REPORT_AGE_BUCKETS):
+			labels.append("{previous:d}-{days:d}d".format(days=days, previous=previous))
+			cases.append("WHEN checksum_timestamp >= ? THEN {bucket:d}".format(bucket=i + 1))
+			parameters += (now - (days * 86400),)
+			previous = days
+		labels.append(">{days:d}d".format(days=previous))
+		cur = self.query("SELECT CASE " + " ".join(cases) + " ELSE {bucket:d} END AS bucket, COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes FROM media GROUP BY bucket ORDER BY bucket".format(bucket=len(labels) - 1), parameters)
+		return (["age", "files", "bytes"], ((labels[bucket], files, bytes) for (bucket, files, bytes) in cur))
+
+	def query(self, sql, parameters):
+		cur = self.cnx.cursor()
+		cur.row_factory = None
+		return cur.execute(sql, parameters)
+
+
+# A lightweight, read-only representation of a row of the media table, for iterating over
+# the whole table (in reports, for example) without the overhead of a MediaRow per row.
+MediaRecord = collections.namedtuple("MediaRecord", ["id", "path", "size", "checksum", "checksum_timestamp", "strong_checksum", "transcode_errors", "transcode_timestamp", "device", "inode"])
 
 
 class MediaRow(object):
@@ -230,14 +1414,25 @@ class MediaRow(object):
 	def clear(self):
 		self.id = None
 		self._checksum = None
+		self.checksum_changed_timestamp = None
+		self.checksum_duration = None
 		self.checksum_timestamp = None
 		self.checksum_updated = False
+		self.device = None
+		self.inode = None
 		self._transcode_errors = None
 		self.transcode_errors_updated = False
+		self.transcode_duration = None
 		self.transcode_timestamp = None
+		self.measurements = []
+		self.chunks = {}
 		self.path = None
+		self.resume_crc = None
+		self.resume_mtime = None
+		self.resume_offset = None
 		self._size = None
 		self.size_updated = False
+		self._strong_checksum = None
 
 	@property
 	def checksum(self):
@@ -257,6 +1452,8 @@ class MediaRow(object):
 		else:
 			self.checksum_updated = False
 		if self.checksum_updated and (original_checksum is not None):
+			if self._checksum is not None:
+				self.checksum_changed_timestamp = time.time()
 			logentry = u"checksum({path}): {original_checksum} => {checksum}".format(
 				checksum=self._checksum,
 				original_checksum=original_checksum,
@@ -294,6 +1491,28 @@ class MediaRow(object):
 			)
 			logging.log(logging_level, logentry)
 
+	@property
+	def strong_checksum(self):
+		return self._strong_checksum
+
+	@strong_checksum.setter
+	def strong_checksum(self, value):
+		original_strong_checksum = self._strong_checksum
+		self._strong_checksum = value
+		if (original_strong_checksum is None) or (value is None) or (original_strong_checksum == value):
+			return
+		# Only a change in the digest computed by the same algorithm indicates that the file changed.
+		if original_strong_checksum.split(":", 1)[0] == value.split(":", 1)[0]:
+			logging_level = logging.ERROR
+		else:
+			logging_level = logging.INFO
+		logentry = u"strong checksum({path}): {original_strong_checksum} => {strong_checksum}".format(
+			original_strong_checksum=original_strong_checksum,
+			path=self.path,
+			strong_checksum=value
+		)
+		logging.log(logging_level, logentry)
+
 	@property
 	def transcode_errors(self):
 		return self._transcode_errors
@@ -322,7 +1541,29 @@ class MediaRow(object):
 			logging.log(logging_level, logentry)
 
 	def load(self, row):
-		(self.id, self.checksum, self.checksum_timestamp, self.transcode_errors, self.transcode_timestamp, self.path, self.size) = row
+		self.id = row["ROWID"]
+		self.path = row["path"]
+		self.checksum = row["checksum"]
+		self.checksum_changed_timestamp = row["checksum_changed_timestamp"]
+		self.checksum_duration = row["checksum_duration"]
+		self.checksum_timestamp = row["checksum_timestamp"]
+		self.device = row["device"]
+		self.inode = row["inode"]
+		self.strong_checksum = row["strong_checksum"]
+		self.transcode_errors = row["transcode_errors"]
+		self.transcode_duration = row["transcode_duration"]
+		self.transcode_timestamp = row["transcode_timestamp"]
+		self.resume_crc = row["resume_crc"]
+		self.resume_mtime = row["resume_mtime"]
+		self.resume_offset = row["resume_offset"]
+		self.size = row["size"]
+
+	def measure(self, operation, bytes, seconds):
+		if operation == "checksum":
+			self.checksum_duration = seconds
+		else:
+			self.transcode_duration = seconds
+		self.measurements.append((operation, bytes, seconds))
 
 	def remove(self):
 		logging.warning(u"exists({path}): True => False".format(path=self.path))
@@ -332,99 +1573,972 @@ class MediaRow(object):
 
 	def save(self):
 		if self.id is None:
-			self.cur.execute("INSERT INTO media (checksum, checksum_timestamp, transcode_errors, transcode_timestamp, path, size) VALUES (?, ?, ?, ?, ?, ?)", (self.checksum, self.checksum_timestamp, self.transcode_errors, self.transcode_timestamp, self.path, self.size))
+			self.cur.execute("INSERT INTO media (checksum, checksum_changed_timestamp, checksum_duration, checksum_timestamp, device, inode, resume_crc, resume_mtime, resume_offset, strong_checksum, transcode_errors, transcode_duration, transcode_timestamp, path, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (self.checksum, self.checksum_changed_timestamp, self.checksum_duration, self.checksum_timestamp, self.device, self.inode, self.resume_crc, self.resume_mtime, self.resume_offset, self.strong_checksum, self.transcode_errors, self.transcode_duration, self.transcode_timestamp, self.path, self.size))
 			self.id = self.cur.lastrowid
 			logging.debug(u"exists({path}): False => True".format(path=self.path))
 		else:
-			self.cur.execute("UPDATE media SET checksum=?, checksum_timestamp=?, transcode_errors=?, transcode_timestamp=?, path=?, size=? WHERE ROWID=?", (self.checksum, self.checksum_timestamp, self.transcode_errors, self.transcode_timestamp, self.path, self.size, self.id))
+			# The path is left alone, in case the media file has been moved (see MediaDB.move_path()).
+			self.cur.execute("UPDATE media SET checksum=?, checksum_changed_timestamp=?, checksum_duration=?, checksum_timestamp=?, device=?, inode=?, resume_crc=?, resume_mtime=?, resume_offset=?, strong_checksum=?, transcode_errors=?, transcode_duration=?, transcode_timestamp=?, size=? WHERE ROWID=?", (self.checksum, self.checksum_changed_timestamp, self.checksum_duration, self.checksum_timestamp, self.device, self.inode, self.resume_crc, self.resume_mtime, self.resume_offset, self.strong_checksum, self.transcode_errors, self.transcode_duration, self.transcode_timestamp, self.size, self.id))
+		self.save_chunks()
 		self.db.commit()
 
+	def share(self, other):
+		"""
+		Adopt the results of the verification of other, another path to the same physical file
+		(so that a file that is reachable by several paths only has to be read once).
+		"""
+		logging.info(u"sharing media verification with alias {alias}: {path}".format(alias=other.path, path=self.path))
+		self.size = other.size
+		self.checksum = other.checksum
+		self.checksum_duration = other.checksum_duration
+		self.checksum_timestamp = other.checksum_timestamp
+		self.device = other.device
+		self.inode = other.inode
+		self.resume_crc = None
+		self.resume_mtime = None
+		self.resume_offset = None
+		self.strong_checksum = other.strong_checksum
+		self.transcode_errors = other.transcode_errors
+		self.transcode_duration = other.transcode_duration
+		self.transcode_timestamp = other.transcode_timestamp
+
+	def save_chunks(self):
+		"""
+		Save the chunk checksums computed by the latest verification, logging any chunk whose
+		checksum has changed (which identifies the region of the file that has changed).
+		"""
+		for (chunk, crc) in sorted(self.chunks.iteritems()):
+			self.cur.execute("SELECT crc FROM chunks WHERE media = ? AND chunk = ?", (self.id, chunk))
+			row = self.cur.fetchone()
+			if (row is not None) and (row["crc"] != crc):
+				logentry = u"chunk checksum({path}) [bytes {start:,d}-{end:,d}]: {original_crc} => {crc}".format(
+					crc=crc,
+					end=min((chunk + 1) * CHUNK_SIZE, self.size) - 1,
+					original_crc=row["crc"],
+					path=self.path,
+					start=chunk * CHUNK_SIZE
+				)
+				logging.error(logentry)
+			self.cur.execute("INSERT OR REPLACE INTO chunks (media, chunk, crc) VALUES (?, ?, ?)", (self.id, chunk, crc))
+		self.chunks = {}
+
+
+class ReadLimiter(object):
+	"""
+	Limits the rate at which all verifications (together) read from disk to rate bytes per
+	second, so that verification can run alongside other users of the disks.  If a maximum
+	I/O latency (in milliseconds) is given, the average latency of each device is sampled from
+	/proc/diskstats and, whenever it exceeds the maximum, the rate at which that device is read
+	is halved (down to 1/MAXIMUM_BACKOFF of the rate), recovering as its latency falls again.
+	Each device is held to its own (backed off) rate by a clock of its own, as well as to the
+	overall rate by a clock shared by every device, so a slow device leaves the rest of the
+	overall rate to the others rather than slowing them down too.
+	"""
+	def __init__(self, rate, maximum_latency=None):
+		self.backoff = {}
+		self.clock = 0.0
+		self.clocks = {}
+		self.lock = threading.Lock()
+		self.maximum_latency = maximum_latency
+		self.rate = float(rate)
+		self.samples = {}
+
+	def delay(self, device, bytes):
+		"""
+		Reserve the reading of the given number of bytes from device, and return the number of
+		seconds to wait before reading them.
+		"""
+		with self.lock:
+			now = time.time()
+			self.clock = max(self.clock, now) + (bytes / self.rate)
+			clock = max(self.clocks.get(device, 0.0), now) + (bytes * self.sample(device, now) / self.rate)
+			self.clocks[device] = clock
+			return max(self.clock, clock) - now
+
+	def device(self, device):
+		return DeviceReadLimiter(self, device)
+
+	def govern(self, proc, device, finished):
+		"""
+		Hold the reads made by a child process (as counted in /proc/<pid>/io) to the rate, by
+		stopping it for as long as it is ahead of the rate, until finished is set.
+		"""
+		path = "/proc/{pid:d}/io".format(pid=proc.pid)
+		charged = 0
+		while not finished.wait(GOVERNOR_INTERVAL):
+			try:
+				with open(path) as f:
+					read = dict(line.split(":", 1) for line in f)["rchar"]
+			except (IOError, KeyError, ValueError):
+				return
+			delay = self.delay(device, int(read) - charged)
+			charged = int(read)
+			if delay > 0:
+				try:
+					proc.send_signal(signal.SIGSTOP)
+					finished.wait(delay)
+					proc.send_signal(signal.SIGCONT)
+				except OSError:
+					return
+
+	def sample(self, device, now):
+		"""
+		Return the factor by which reads from device are currently being slowed down (updating
+		it from /proc/diskstats at most once every LATENCY_SAMPLE_INTERVAL seconds).
+		"""
+		if self.maximum_latency is None:
+			return 1
+		backoff = self.backoff.get(device, 1)
+		previous = self.samples.get(device)
+		if (previous is not None) and (now - previous[0] < LATENCY_SAMPLE_INTERVAL):
+			return backoff
+		stats = diskstats(device)
+		if stats is None:
+			return backoff
+		self.samples[device] = (now, stats)
+		if previous is None:
+			return backoff
+		ios = stats[0] - previous[1][0]
+		if ios <= 0:
+			latency = 0.0
+		else:
+			latency = float(stats[1] - previous[1][1]) / ios
+		if latency > self.maximum_latency:
+			if backoff < MAXIMUM_BACKOFF:
+				backoff = backoff * 2
+				logging.info("device {device:d}:{minor:d} latency is {latency:,.1f}ms, slowing reads from it to 1/{backoff:d} of the maximum read rate".format(backoff=backoff, device=os.major(device), latency=latency, minor=os.minor(device)))
+		elif backoff > 1:
+			backoff = backoff // 2
+			logging.info("device {device:d}:{minor:d} latency is {latency:,.1f}ms, speeding reads from it up to 1/{backoff:d} of the maximum read rate".format(backoff=backoff, device=os.major(device), latency=latency, minor=os.minor(device)))
+		self.backoff[device] = backoff
+		return backoff
+
+	def wait(self, device, bytes):
+		delay = self.delay(device, bytes)
+		if delay > 0:
+			time.sleep(delay)
+
+
+class DeviceReadLimiter(object):
+	"""
+	A ReadLimiter, bound to the device that is being read.
+	"""
+	def __init__(self, limiter, device):
+		self.device = device
+		self.limiter = limiter
+
+	def govern(self, proc, finished):
+		self.limiter.govern(proc, self.device, finished)
+
+	def wait(self, bytes):
+		self.limiter.wait(self.device, bytes)
+
+
+def diskstats(device):
+	"""
+	Return a tuple of the number of I/Os completed by device and the number of milliseconds
+	spent on them (from /proc/diskstats), or None if the device has no statistics (as is the
+	case for network and virtual filesystems, for example).
+	"""
+	major = os.major(device)
+	minor = os.minor(device)
+	try:
+		with open("/proc/diskstats") as f:
+			for line in f:
+				fields = line.split()
+				if (int(fields[0]) == major) and (int(fields[1]) == minor):
+					return (int(fields[3]) + int(fields[7]), int(fields[6]) + int(fields[10]))
+	except (IOError, IndexError, ValueError):
+		pass
+	return None
+
+
+def deprioritize(nice, ionice):
+	"""
+	Lower the CPU (nice) and I/O (ionice) scheduling priority of this process, which is
+	inherited by every thread and child process that it subsequently starts.
+	"""
+	if nice is not None:
+		os.nice(nice)
+	if ionice is not None:
+		ioclass = {"best-effort": "2", "idle": "3"}[ionice]
+		try:
+			if subprocess.call(["/usr/bin/ionice", "-c", ioclass, "-p", str(os.getpid())], close_fds=True) != 0:
+				logging.warning("unable to set I/O scheduling class: {ionice}".format(ionice=ionice))
+		except OSError, e:
+			logging.warning("unable to set I/O scheduling class ({ionice}): {error}".format(error=e.strerror, ionice=ionice))
+
+
+class RunStatistics(object):
+	"""
+	Per-phase timings and counters for a run, for a summary at the end of the run and for
+	export as JSON or in the format of the Prometheus node exporter's textfile collector.  The
+	checksum and transcode phases are measured in worker time (summed over every concurrent
+	verification), all other phases in elapsed time.
+	"""
+	PHASES = ["walk", "discovery_insert", "prune", "verification", "checksum", "transcode"]
+
+	def __init__(self, started):
+		self.counters = collections.defaultdict(int)
+		self.devices = {}
+		self.phases = {}
+		self.queue_depth = (0, 0, 0)
+		self.started = started
+
+	def add_phase(self, name, seconds):
+		self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+	def count(self, name, value=1):
+		self.counters[name] += value
+
+	def measure(self, device, operation, bytes, seconds):
+		"""
+		Record a verification operation (see MediaRow.measure()) on a device.
+		"""
+		self.add_phase(operation, seconds)
+		self.count("bytes_read", bytes)
+		(total_bytes, total_seconds) = self.devices.get(device, (0, 0.0))
+		self.devices[device] = (total_bytes + bytes, total_seconds + seconds)
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		started = time.time()
+		try:
+			yield self
+		finally:
+			self.add_phase(name, time.time() - started)
+
+	def sample_queue_depth(self, depth):
+		(samples, total, maximum) = self.queue_depth
+		self.queue_depth = (samples + 1, total + depth, max(maximum, depth))
+
+	def summary(self):
+		verification = self.phases.get("verification", 0.0)
+		(samples, total, maximum) = self.queue_depth
+		return collections.OrderedDict([
+			("started", self.started),
+			("duration", time.time() - self.started),
+			("phases", collections.OrderedDict((name, self.phases.get(name, 0.0)) for name in self.PHASES)),
+			("media", collections.OrderedDict((name, self.counters[name]) for name in ["found", "new", "pruned", "verified", "shared", "failed"])),
+			("bytes_read", self.counters["bytes_read"]),
+			("bytes_per_second", (self.counters["bytes_read"] / verification) if verification > 0 else None),
+			("files_per_second", (self.counters["verified"] / verification) if verification > 0 else None),
+			("queue_depth", collections.OrderedDict([("mean", (float(total) / samples) if samples > 0 else None), ("maximum", maximum)])),
+			("devices", collections.OrderedDict(
+				("{major:d}:{minor:d}".format(major=os.major(device), minor=os.minor(device)), collections.OrderedDict([("bytes", bytes), ("seconds", seconds), ("bytes_per_second", (bytes / seconds) if seconds > 0 else None)]))
+				for (device, (bytes, seconds)) in sorted(self.devices.iteritems())
+			))
+		])
+
+	def timed(self, name, iterable):
+		"""
+		Yield from iterable, recording the time spent waiting on it as the named phase.
+		"""
+		iterator = iter(iterable)
+		while True:
+			started = time.time()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				self.add_phase(name, time.time() - started)
+				return
+			self.add_phase(name, time.time() - started)
+			yield item
+
+	def log(self):
+		summary = self.summary()
+		logging.info("run summary: {duration:,.1f} seconds, {found:,d} media files found ({new:,d} new, {pruned:,d} pruned), {verified:,d} verified ({shared:,d} shared with aliases, {failed:,d} failed), {bytes:,d} bytes read".format(bytes=summary["bytes_read"], duration=summary["duration"], **summary["media"]))
+		logging.info("phase timings: " + ", ".join("{name} {seconds:,.1f}s".format(name=name, seconds=seconds) for (name, seconds) in summary["phases"].iteritems()))
+		if summary["files_per_second"] is not None:
+			logging.info("verification rate: {files:,.2f} files/second, {rate:,.0f} bytes/second (queue depth: mean {mean:,.1f}, maximum {maximum:,d})".format(files=summary["files_per_second"], maximum=summary["queue_depth"]["maximum"], mean=summary["queue_depth"]["mean"] or 0.0, rate=summary["bytes_per_second"]))
+		for (device, stats) in summary["devices"].iteritems():
+			if stats["bytes_per_second"] is not None:
+				logging.info("device {device} read rate: {rate:,.0f} bytes/second".format(device=device, rate=stats["bytes_per_second"]))
+
+	def write_json(self, path):
+		with atomic_write(path) as f:
+			json.dump(self.summary(), f, indent=2)
+			f.write("\n")
+
+	def write_prometheus(self, path):
+		summary = self.summary()
+		metrics = [
+			("media_check_last_run_timestamp_seconds", "gauge", "When the last media_check run started.", [("", summary["started"])]),
+			("media_check_run_duration_seconds", "gauge", "How long the last media_check run took.", [("", summary["duration"])]),
+			("media_check_phase_seconds", "gauge", "Time spent in each phase of the last media_check run.", [("phase=\"{name}\"".format(name=name), seconds) for (name, seconds) in summary["phases"].iteritems()]),
+			("media_check_media_files", "gauge", "Media files handled by the last media_check run.", [("result=\"{name}\"".format(name=name), value) for (name, value) in summary["media"].iteritems()]),
+			("media_check_read_bytes", "gauge", "Bytes read by the last media_check run.", [("", summary["bytes_read"])]),
+			("media_check_queue_depth", "gauge", "Verifications queued or in progress during the last media_check run.", [("statistic=\"{name}\"".format(name=name), value) for (name, value) in summary["queue_depth"].iteritems() if value is not None]),
+			("media_check_device_read_bytes", "gauge", "Bytes read from each device by the last media_check run.", [("device=\"{device}\"".format(device=device), stats["bytes"]) for (device, stats) in summary["devices"].iteritems()]),
+			("media_check_device_read_seconds", "gauge", "Time spent reading from each device by the last media_check run.", [("device=\"{device}\"".format(device=device), stats["seconds"]) for (device, stats) in summary["devices"].iteritems()])
+		]
+		with atomic_write(path) as f:
+			for (name, kind, description, samples) in metrics:
+				f.write("# HELP {name} {description}\n# TYPE {name} {kind}\n".format(description=description, kind=kind, name=name))
+				for (labels, value) in samples:
+					if labels:
+						labels = "{" + labels + "}"
+					f.write("{name}{labels} {value!r}\n".format(labels=labels, name=name, value=float(value)))
+
+
+def report_statistics(statistics, arguments):
+	statistics.log()
+	if arguments.stats_file is not None:
+		statistics.write_json(arguments.stats_file)
+	if arguments.prometheus_textfile is not None:
+		statistics.write_prometheus(arguments.prometheus_textfile)
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+	"""
+	Write to a temporary file alongside path, and rename it over path once it is complete (so
+	that readers, such as the node exporter, never see a partially written file).
+	"""
+	temporary = "{path}.{pid:d}.tmp".format(path=path, pid=os.getpid())
+	try:
+		with open(temporary, "w") as f:
+			yield f
+		os.rename(temporary, path)
+	except:
+		if os.path.exists(temporary):
+			os.unlink(temporary)
+		raise
+
+
+class PendingScheduler(object):
+	"""
+	Hands out pending media files while capping the number of concurrent verifications
+	on each device (st_dev), so that parallel readers are spread across disks instead of
+	seeking against each other on the same spindle.  Pending files whose device is already
+	saturated are held back (in the order they were fetched) until a verification on that
+	device finishes; at most `lookahead` files are held back at any one time.  If a fits
+	function is given, pending files for which it returns False (i.e. that are predicted not
+	to fit within the time remaining) are passed over.
+	"""
+	def __init__(self, fetch, jobs_per_device, lookahead, fits=None):
+		self.active = {}
+		self.backlog = []
+		self.devices = {}
+		self.drained = False
+		self.fetch = fetch
+		self.fits = fits
+		self.jobs_per_device = jobs_per_device
+		self.lookahead = lookahead
+		self.rejected = 0
+		self.skipped = set()
+
+	def available(self, device):
+		return (not self.jobs_per_device) or (self.active.get(device, 0) < self.jobs_per_device)
+
+	def exhausted(self):
+		return self.drained and (len(self.backlog) == 0)
+
+	def finish(self, m):
+		device = self.devices.pop(m.id)
+		self.active[device] -= 1
+		return device
+
+	def refresh(self):
+		"""
+		Fetch pending media files again, even if none were pending when last fetched.
+		"""
+		self.drained = False
+		self.rejected = 0
+
+	def next(self):
+		"""
+		Return a (MediaRow, device) tuple for the next media file that may be verified, or
+		(None, None) if no media file can currently be dispatched.  The device is None if the
+		media file no longer exists on disk.
+		"""
+		for i, (m, device) in enumerate(self.backlog):
+			if self.available(device):
+				del self.backlog[i]
+				return (m, device)
+
+		while (not self.drained) and (len(self.backlog) < self.lookahead):
+			exclude = self.skipped.union(self.devices, (m.id for (m, device) in self.backlog))
+			m = self.fetch(exclude)
+			if m is None:
+				self.drained = True
+				break
+			try:
+				st = os.stat(m.path)
+			except OSError:
+				return (m, None)
+			if not stat.S_ISREG(st.st_mode):
+				return (m, None)
+			if (self.fits is not None) and (not self.fits(m, st.st_dev)):
+				# Give up once it seems that nothing that is pending will fit.
+				self.rejected += 1
+				if self.rejected >= BUDGET_SKIP_LIMIT:
+					logging.info("no pending media verifications are predicted to fit within the remaining run time")
+					self.drained = True
+				continue
+			self.rejected = 0
+			if self.available(st.st_dev):
+				return (m, st.st_dev)
+			logging.debug(u"deferring media verification (device {device} is busy): {path}".format(device=st.st_dev, path=m.path))
+			self.backlog.append((m, st.st_dev))
+		return (None, None)
+
+	def skip(self, m):
+		self.skipped.add(m.id)
+
+	def start(self, m, device):
+		self.devices[m.id] = device
+		self.active[device] = self.active.get(device, 0) + 1
+
+
+class VerificationPool(object):
+	"""
+	A bounded pool of worker threads that verify media files concurrently.  Workers only
+	read from disk and run external commands; every MediaRow that they verify is handed
+	back through collect() so that all database updates are applied by a single writer.
+	"""
+	def __init__(self, jobs, verify):
+		self.completed = Queue.Queue()
+		self.in_flight = {}
+		self.jobs = jobs
+		self.pending = Queue.Queue()
+		self.verify = verify
+		self.workers = []
+		for i in range(jobs):
+			worker = threading.Thread(target=self.work, name="verifier-{i}".format(i=i))
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def busy(self):
+		return len(self.in_flight) > 0
+
+	def collect(self, timeout=None):
+		"""
+		Return a (MediaRow, exc_info) tuple for the next media file whose verification has
+		finished, waiting for up to timeout seconds (or indefinitely) for one to finish, where
+		exc_info is the sys.exc_info() of the exception that its verification raised (or None
+		if it succeeded).  Returns (None, None) if the timeout expires.
+		"""
+		if timeout is not None:
+			try:
+				(m, exc_info) = self.completed.get(timeout > 0, timeout)
+			except Queue.Empty:
+				return (None, None)
+		else:
+			while True:
+				try:
+					(m, exc_info) = self.completed.get(True, 1)
+					break
+				except Queue.Empty:
+					# Poll with a timeout so that a blocked collect() remains interruptible.
+					continue
+		del self.in_flight[m.id]
+		return (m, exc_info)
+
+	def idle(self):
+		return self.jobs - len(self.in_flight)
+
+	def submit(self, m):
+		self.in_flight[m.id] = m
+		self.pending.put(m)
+
+	def work(self):
+		while True:
+			m = self.pending.get()
+			try:
+				self.verify(m)
+				self.completed.put((m, None))
+			except Exception:
+				self.completed.put((m, sys.exc_info()))
+
+
+class Verifier(object):
+	"""
+	Dispatches pending media files to a VerificationPool (via a PendingScheduler) and saves
+	the results of their verification, until either --maximum-run-time has elapsed or
+	--maximum-media-verifications media files have been verified.  Media files whose paths
+	are queued in priority are verified before any other pending media files.  Each physical
+	file is only read once, however many paths (hard links, or paths through symbolic links)
+	it is reachable by: its other paths share the results of that verification.
+	"""
+	def __init__(self, db, arguments, started, statistics=None):
+		self.aliases = {}
+		self.arguments = arguments
+		self.checksum_threshold = None
+		self.current_partition = None
+		self.db = db
+		self.deadline = None
+		self.identities = {}
+		if arguments.maximum_run_time is not None:
+			self.deadline = started + arguments.maximum_run_time
+		self.limiter = None
+		if arguments.max_read_rate is not None:
+			self.limiter = ReadLimiter(arguments.max_read_rate, arguments.max_io_latency)
+		self.pending = None
+		self.refresh_at = None
+		self.pool = VerificationPool(arguments.jobs, lambda m: verify(m, self.checksum_threshold, arguments.strong_checksum, arguments.single_read, self.deadline, arguments.transcode_mode, arguments.transcode_error_limit, self.limiter))
+		self.priority = collections.deque()
+		self.scheduler = PendingScheduler(self.fetch, arguments.jobs_per_device, arguments.jobs * 8, self.fits)
+		self.statistics = statistics
+		self.stopped = False
+		self.throughput = db.load_throughput()
+		self.tool_error = None
+		self.verifications = 0
+		self.update_thresholds()
+
+	def collect(self, timeout=None):
+		(m, exc_info) = self.pool.collect(timeout)
+		if m is not None:
+			device = self.scheduler.finish(m)
+			identity = self.identities.pop(m.id)
+			if exc_info is not None:
+				# Nothing is saved for a failed verification (so it remains pending, for a later
+				# run), and paths that were waiting for it will also be verified by a later run.
+				if issubclass(exc_info[0], ToolError):
+					# Every other verification would fail in the same way.
+					if self.tool_error is None:
+						logging.error(u"{error}, exiting...".format(error=exc_info[1]))
+					self.tool_error = exc_info[1]
+					self.stopped = True
+				else:
+					logging.error(u"media verification failed: {path}".format(path=m.path), exc_info=exc_info)
+				self.aliases.pop(identity, None)
+				self.scheduler.skip(m)
+				if self.statistics is not None:
+					self.statistics.count("failed")
+				return m
+			with self.db.transaction():
+				m.save()
+				for (operation, bytes, seconds) in m.measurements:
+					self.db.record_throughput(self.throughput, device, operation, bytes, seconds)
+					if self.statistics is not None:
+						self.statistics.measure(device, operation, bytes, seconds)
+				# Paths that were waiting for this verification share its results (unless it was
+				# paused, in which case they will be verified by a later run).
+				for alias in self.aliases.pop(identity, []):
+					if (m.resume_offset is None) and (m.checksum_timestamp is not None):
+						alias.share(m)
+						alias.save()
+						if self.statistics is not None:
+							self.statistics.count("shared")
+			if self.statistics is not None:
+				self.statistics.count("verified")
+				self.statistics.sample_queue_depth(len(self.pool.in_flight) + len(self.scheduler.backlog))
+		return m
+
+	def dispatch(self):
+		"""
+		Dispatch pending media files until either every worker is busy, no pending media file
+		can currently be dispatched, or a limit on this run has been reached (in which case
+		the verifier is stopped).  Verifications that are already in progress are unaffected.
+		"""
+		while (not self.stopped) and (self.pool.idle() > 0):
+			if (self.deadline is not None) and (time.time() > self.deadline):
+				logging.info("maximum allowable run time ({maximum_run_time} seconds) has elapsed, exiting...".format(maximum_run_time=self.arguments.maximum_run_time))
+				self.stopped = True
+				break
+
+			if (self.arguments.maximum_media_verifications is not None) and (self.verifications >= self.arguments.maximum_media_verifications):
+				logging.info("maximum allowable media verifications ({maximum_media_verifications}) have been executed, exiting...".format(maximum_media_verifications=self.arguments.maximum_media_verifications))
+				self.stopped = True
+				break
+
+			(m, device) = self.scheduler.next()
+			if m is None:
+				# Either nothing is pending, or every pending media file is on a busy device.
+				break
+			if device is None:
+				if self.arguments.prune:
+					m.remove()
+				else:
+					logging.warning(u"skipping media verification (file does not exist): {path}".format(path=m.path))
+					self.scheduler.skip(m)
+			elif not self.share(m):
+				self.verifications += 1
+				logging.info(u"verifying media: {path}".format(path=m.path))
+				self.scheduler.start(m, device)
+				self.pool.submit(m)
+
+	def fetch(self, exclude):
+		exclude = exclude.union(alias.id for aliases in self.aliases.itervalues() for alias in aliases)
+		while self.priority:
+			m = self.db.fetch_path(self.priority.popleft())
+			if (m is not None) and (m.id not in exclude):
+				return m
+		if self.pending is None:
+			self.pending = self.db.iterate_pending(self.checksum_threshold, self.current_partition, self.arguments.checksum_interval)
+		for m in self.pending:
+			if m.id not in exclude:
+				return m
+		return None
+
+	def fits(self, m, device):
+		"""
+		Predict (from the throughput that has been observed on its device) whether the
+		verification of m would finish before --maximum-run-time elapses.  Media files whose
+		verification time cannot be predicted are assumed to fit.
+		"""
+		if (self.deadline is None) or (self.checksum_threshold is None) or (m.size is None):
+			return True
+		if (m.checksum_timestamp is not None) and (m.checksum_timestamp >= self.checksum_threshold):
+			return True
+		predicted = 0.0
+		for (operation, size) in verification_operations(m, self.arguments.single_read, resumable(m, self.arguments.strong_checksum), self.arguments.transcode_mode):
+			(bytes, seconds) = self.throughput.get((device, operation), (0.0, 0.0))
+			if (bytes <= 0) or (seconds <= 0):
+				return True
+			predicted += size * seconds / bytes
+		if time.time() + predicted <= self.deadline:
+			return True
+		logging.debug(u"passing over media verification (predicted to take {predicted:,.0f} seconds): {path}".format(path=m.path, predicted=predicted))
+		return False
+
+	def share(self, m):
+		"""
+		Avoid reading a physical file more than once: if another path to the file that m refers
+		to is being verified now, hold m back until that verification finishes (see collect()),
+		or if one has been verified since the file was last modified (and within the checksum
+		interval), share its results with m immediately.  Returns False if m must be verified.
+		"""
+		try:
+			st = os.stat(m.path)
+		except OSError:
+			return False
+		identity = (st.st_dev, st.st_ino)
+		if identity in self.aliases:
+			logging.debug(u"deferring media verification (an alias is being verified): {path}".format(path=m.path))
+			self.aliases[identity].append(m)
+			return True
+		if self.checksum_threshold is not None:
+			alias = self.db.fetch_alias(m, st.st_dev, st.st_ino, st.st_size, max(st.st_mtime, self.checksum_threshold))
+			strong_algorithm = self.arguments.strong_checksum
+			if (alias is not None) and ((strong_algorithm is None) or (alias.strong_checksum or "").startswith(strong_algorithm + ":")):
+				with self.db.transaction():
+					m.share(alias)
+					m.save()
+				if self.statistics is not None:
+					self.statistics.count("shared")
+				return True
+		self.aliases[identity] = []
+		self.identities[m.id] = identity
+		return False
+
+	def poll(self):
+		"""
+		Look for pending media files afresh if any may have become pending since the last time
+		that we looked: either paths have been queued in priority, or a media file has fallen
+		due for verification (see update_thresholds()).
+		"""
+		if (self.refresh_at is not None) and (time.time() >= self.refresh_at):
+			self.refresh()
+		elif self.priority:
+			self.scheduler.refresh()
+
+	def refresh(self):
+		"""
+		Look for pending media files afresh (i.e. including any that have become pending since
+		the last time that we looked).
+		"""
+		self.update_thresholds()
+		self.pending = None
+		self.scheduler.refresh()
+
+	def run(self):
+		"""
+		Verify pending media files until either there are no more pending media files or a
+		limit on this run has been reached, and then wait for all verifications to finish.
+		"""
+		while True:
+			self.dispatch()
+			if (not self.stopped) and self.scheduler.exhausted():
+				logging.info("no pending media verifications to execute, exiting...")
+				self.stopped = True
+			if not self.pool.busy():
+				break
+			self.collect()
+
+	def update_thresholds(self):
+		current_partition = self.current_partition
+		(self.checksum_threshold, self.current_partition) = verification_thresholds(self.arguments.checksum_interval, self.arguments.divide_verification_evenly)
+		if (self.current_partition is not None) and (self.current_partition != current_partition):
+			logging.info("partitioning media files evenly over the checksum interval: verifying partition {current_partition:,d} of {maximum_partition:,d}".format(current_partition=self.current_partition, maximum_partition=self.arguments.checksum_interval))
+		# No media file that is not pending now becomes pending (other than by being changed)
+		# until the current partition changes at midnight or, if we are not partitioning the
+		# data, until the least recently verified media file falls out of the checksum interval.
+		if self.current_partition is not None:
+			self.refresh_at = (datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time.min) - datetime.datetime.fromtimestamp(0)).total_seconds()
+		elif self.checksum_threshold is not None:
+			self.refresh_at = (self.db.earliest_verification(self.checksum_threshold) or time.time()) + (self.arguments.checksum_interval * 86400)
+		else:
+			self.refresh_at = None
+
+
+class Inotify(object):
+	"""
+	A minimal (ctypes) binding to the Linux inotify API.
+	"""
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_ISDIR = 0x40000000
+
+	EVENT = struct.Struct("iIII")
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+
+	def add_watch(self, path, mask):
+		wd = self.libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error), path)
+		return wd
+
+	def read(self, timeout):
+		"""
+		Wait for up to timeout seconds for events, and return a list of (wd, mask, cookie, name)
+		tuples for those that arrive (name is empty for events on a watched directory itself).
+		"""
+		events = []
+		(readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return events
+		data = os.read(self.fd, 65536)
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = self.EVENT.unpack_from(data, offset)
+			offset += self.EVENT.size
+			events.append((wd, mask, cookie, data[offset:offset + length].rstrip("\0")))
+			offset += length
+		return events
+
+	def rm_watch(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+
+class MediaWatcher(object):
+	"""
+	Watches directories (via inotify) and keeps the media table up to date as media files are
+	written, moved and deleted within them.  The paths of media files that are added or
+	changed are queued in priority, for immediate verification.  Media files (and directories)
+	that are moved within the watched directories keep everything known about them.
+	"""
+	MASK = Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | Inotify.IN_ONLYDIR
+
+	def __init__(self, db, matcher, priority):
+		self.db = db
+		self.directories = {}
+		self.inotify = Inotify()
+		self.matcher = matcher
+		self.moves = {}
+		self.priority = priority
+		self.reads = 0
+		self.watches = {}
+
+	def add_tree(self, directory):
+		scanned = {}
+		media = list(find_media(directory, self.matcher, None, scanned))
+		for path in scanned:
+			self.watch(path.encode("utf-8"))
+		for (path, size, device, inode) in media:
+			self.update(path.encode("utf-8"))
+
+	def handle(self, mask, cookie, path, name):
+		directory = bool(mask & Inotify.IN_ISDIR) or (path in self.watches)
+		if mask & Inotify.IN_MOVED_FROM:
+			# This may be the first half of a move within the watched directories, so the removal
+			# is held back until the end of the next read (see process()).
+			self.moves.setdefault(cookie, (self.reads, []))[1].append((path, name, directory))
+		elif mask & Inotify.IN_DELETE:
+			self.remove(path, name, directory)
+		elif (mask & Inotify.IN_MOVED_TO) and (cookie in self.moves):
+			# Of the paths (through symbolic links) that the move was seen from, pair this path
+			# with the one that it has the most in common with.
+			sources = self.moves[cookie][1]
+			source = max(sources, key=lambda source: len(os.path.commonprefix([source[0], path])))
+			sources.remove(source)
+			if not sources:
+				del self.moves[cookie]
+			self.move(source, path, name)
+		elif mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+			if os.path.isdir(path):
+				self.add_tree(path)
+			elif self.matcher(name):
+				# A newly created file is still being written (we will see it again once it is
+				# closed), unless it is a link to an existing file.
+				try:
+					linked = os.path.islink(path) or (os.stat(path).st_nlink > 1)
+				except OSError:
+					linked = False
+				if (mask & Inotify.IN_MOVED_TO) or linked:
+					self.update(path)
+		elif mask & Inotify.IN_CLOSE_WRITE:
+			if self.matcher(name):
+				self.update(path)
+
+	def move(self, source, path, name):
+		(source, source_name, directory) = source
+		if directory:
+			self.unwatch_tree(path)
+			prefix = os.path.join(source, "")
+			for watched in [watched for watched in self.watches if (watched == source) or watched.startswith(prefix)]:
+				wd = self.watches.pop(watched)
+				self.directories[wd].discard(watched)
+				self.directories[wd].add(path + watched[len(source):])
+				self.watches[path + watched[len(source):]] = wd
+			self.db.move_tree(unicode(source, "utf-8"), unicode(path, "utf-8"))
+		elif not self.matcher(name):
+			if self.matcher(source_name):
+				self.db.remove_path(unicode(source, "utf-8"))
+		elif not (self.matcher(source_name) and self.db.move_path(unicode(source, "utf-8"), unicode(path, "utf-8"))):
+			self.update(path)
+
+	def process(self, timeout):
+		"""
+		Wait for up to timeout seconds for changes to the watched directories and apply any
+		that arrive.  Returns False if the kernel's event queue overflowed (so that changes
+		may have been missed), and True otherwise.  Media files (and directories) that were moved
+		out of the watched directories (i.e. whose moves were not completed within them by the
+		end of the read after the one in which they began) are removed.
+		"""
+		complete = True
+		for (wd, mask, cookie, name) in self.inotify.read(timeout):
+			if mask & Inotify.IN_Q_OVERFLOW:
+				logging.warning("inotify event queue overflowed, changes to media files may have been missed")
+				complete = False
+				continue
+			if mask & Inotify.IN_IGNORED:
+				for directory in self.directories.pop(wd, ()):
+					del self.watches[directory]
+				continue
+			for directory in list(self.directories.get(wd, ())):
+				path = os.path.join(directory, name)
+				logging.debug(u"inotify event {mask:#010x}: {path}".format(mask=mask, path=unicode(path, "utf-8", errors="replace")))
+				self.handle(mask, cookie, path, name)
+		for (cookie, (reads, sources)) in self.moves.items():
+			if reads < self.reads:
+				del self.moves[cookie]
+				for (path, name, directory) in sources:
+					self.remove(path, name, directory)
+		self.reads += 1
+		return complete
+
+	def remove(self, path, name, directory):
+		if directory:
+			self.unwatch_tree(path)
+			self.db.remove_tree(unicode(path, "utf-8"))
+		elif self.matcher(name):
+			self.db.remove_path(unicode(path, "utf-8"))
+
+	def unwatch_tree(self, directory):
+		prefix = os.path.join(directory, "")
+		for path in [path for path in self.watches if (path == directory) or path.startswith(prefix)]:
+			wd = self.watches.pop(path)
+			self.directories[wd].discard(path)
+			if not self.directories[wd]:
+				del self.directories[wd]
+				self.inotify.rm_watch(wd)
+
+	def update(self, path):
+		try:
+			st = os.stat(path)
+		except OSError:
+			return
+		path = unicode(path, "utf-8")
+		self.db.upsert(path, st.st_size, st.st_dev, st.st_ino)
+		self.priority.append(path)
+
+	def watch(self, directory):
+		if directory in self.watches:
+			return
+		try:
+			wd = self.inotify.add_watch(directory, self.MASK)
+		except OSError, e:
+			logging.warning(u"unable to watch directory {directory}: {error}".format(directory=unicode(directory, "utf-8", errors="replace"), error=e.strerror))
+			return
+		self.watches[directory] = wd
+		self.directories.setdefault(wd, set()).add(directory)
+
 
 if __name__ == "__main__":
 	arguments = configure()
-	db = MediaDB(arguments.database_path)
+	started = time.time()
+	deprioritize(arguments.nice, arguments.ionice)
+	db = MediaDB(arguments.database_path, arguments.sqlite_journal_mode, arguments.sqlite_synchronous, arguments.sqlite_cache_size)
 	if not db.connected():
 		logging.error("no connection to database %s is available", arguments.database_path)
 		sys.exit(7)
 
 	# If we are just reporting the current state of the database, then print the requested
 	# report and immediately exit.
-	if arguments.report is not None:
-		for m in db.iterate_errored(arguments.report):
-			print u"{errors:>3d} {path}".format(errors=m.transcode_errors, path=m.path)
+	if (arguments.report is not None) or (arguments.aggregate_report is not None):
+		report(db, arguments)
 		sys.exit(0)
 
-	# If a hard limit has been put on our execution time, calculate the time after which
-	# we need to exit.
-	if arguments.maximum_run_time is not None:
-		run_time_threshold = time.time() + arguments.maximum_run_time
-	else:
-		run_time_threshold = None
-
 	# Add all new files in the listed directories to the database.
-	for root in arguments.directories:
-		count = 0
-		for root, directories, files in os.walk(root, topdown=False, followlinks=True):
-			for glob in arguments.media_glob:
-				for file in fnmatch.filter(files, glob):
-					count += 1
-					db.ensure_row(unicode(os.path.join(root, file), "utf-8"))
-		logging.info("found {count:,d} media files within root: {root}".format(count=count, root=root))
+	statistics = RunStatistics(started)
+	present = None
+	unchanged = None
+	failed = None
+	if arguments.prune:
+		present = set()
+		unchanged = set()
+		failed = set()
+	scanned = discover_media(db, arguments.directories, arguments.media_glob, arguments.full_scan, present, unchanged, statistics, failed)
 
 	# If pruning is enabled, remove all rows from the database that don't exist on disk.
 	if arguments.prune:
-		for m in db.iterate_all():
-			if not os.path.isfile(m.path):
-				m.remove()
-
-	current_partition = None
-	checksum_threshold = None
-	if arguments.checksum_interval > 0:
-		if arguments.divide_verification_evenly:
-			# If we are attempting to divide our workload in order to distribute it more evenly,
-			# calculate which partition we are currently working on, using the number of days
-			# since the UNIX epoch as our counter.
-			current_partition = (datetime.datetime.today() - datetime.datetime.utcfromtimestamp(0)).days % arguments.checksum_interval
-			logging.info("partitioning media files evenly over the checksum interval: verifying partition {current_partition:,d} of {maximum_partition:,d}".format(current_partition=current_partition, maximum_partition=arguments.checksum_interval))
-			# We are partitioning the data, so calculate our checksum_threshold as 00:00 today (the further restriction of the current partition will
-			# stop us from verifying more media files than we mean to).
-			checksum_threshold = (datetime.datetime.combine(datetime.date.today(), datetime.time.min) - datetime.datetime.fromtimestamp(0)).total_seconds()
-		else:
-			# We are not partitioning the data, so just calculate the checksum_threshold as exactly arguments.checksum_interval days ago.
-			checksum_threshold = (datetime.datetime.now() - datetime.timedelta(days=arguments.checksum_interval) - datetime.datetime.fromtimestamp(0)).total_seconds()
+		with statistics.phase("prune"):
+			statistics.count("pruned", prune_media(db, arguments.directories, arguments.media_glob, present, unchanged, failed))
+		present = None
+		unchanged = None
+		failed = None
 
 	# Loop over our 'pending' (i.e. ready to be verified) media files and verify them
+	# (up to --jobs at a time, and at most --jobs-per-device at a time from any one device)
 	# until either:
 	#   (1) there are no more pending media files.
 	#   (2) we run out of time (as per --maximum-run-time).
 	#   (3) we have verified --maximum-media-verifications media files.
-	media_verification_count = 0
-	while True:
-		if (run_time_threshold is not None) and (time.time() > run_time_threshold):
-			logging.info("maximum allowable run time ({maximum_run_time} seconds) has elapsed, exiting...".format(maximum_run_time=arguments.maximum_run_time))
-			break;
-
-		if (arguments.maximum_media_verifications is not None) and (media_verification_count >= arguments.maximum_media_verifications):
-			logging.info("maximum allowable media verifications ({maximum_media_verifications}) have been executed, exiting...".format(maximum_media_verifications=arguments.maximum_media_verifications))
-			break;
-
-		m = db.fetch_pending(checksum_threshold, current_partition, arguments.checksum_interval)
-		if m is None:
-			logging.info("no pending media verifications to execute, exiting...")
-			break
-		if not os.path.isfile(m.path):
-			if arguments.prune:
-				m.remove()
-			else:
-				logging.warning(u"skipping media verification (file does not exist): {path}".format(path=m.path))
-		else:
-			media_verification_count += 1
-			logging.info(u"verifying media: {path}".format(path=m.path))
-			m.size = os.stat(m.path).st_size
-			if (checksum_threshold is not None) and (m.size_updated or (m.checksum_timestamp is None) or (m.checksum_timestamp < checksum_threshold)):
-				m.checksum = checksum(m.path)
-				m.checksum_timestamp = time.time()
-				if (m.checksum_updated):
-					m.transcode_errors = transcode(m.path)
-					m.transcode_timestamp = time.time()
-			m.save()
+	# Verifications that are already in progress when we stop are allowed to finish.
+	verifier = Verifier(db, arguments, started, statistics)
+	if not arguments.watch:
+		with statistics.phase("verification"):
+			verifier.run()
+		report_statistics(statistics, arguments)
+		sys.exit(0 if verifier.tool_error is None else 1)
+
+	# In watch mode, we keep the database up to date with changes to the directories as they
+	# happen, rather than rescanning them, and verify media files as they are written (as
+	# well as continuing to verify media files as they fall due) until either (2) or (3).
+	watcher = MediaWatcher(db, compile_globs(arguments.media_glob), verifier.priority)
+	for root in scanned:
+		for directory in scanned[root]:
+			watcher.watch(directory.encode("utf-8"))
+	logging.info("watching {count:,d} directories for changes to media files".format(count=len(watcher.watches)))
+	with statistics.phase("verification"):
+		while (not verifier.stopped) or verifier.pool.busy():
+			verifier.poll()
+			verifier.dispatch()
+			with db.transaction():
+				complete = watcher.process(0.5)
+			if not complete:
+				# We have missed changes, so fall back to a (incremental) rescan.
+				for (root, directories) in discover_media(db, arguments.directories, arguments.media_glob, False).iteritems():
+					for directory in directories:
+						watcher.watch(directory.encode("utf-8"))
+				verifier.refresh()
+			while verifier.collect(0) is not None:
+				pass
+	report_statistics(statistics, arguments)
+	sys.exit(0 if verifier.tool_error is None else 1)
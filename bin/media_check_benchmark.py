@@ -0,0 +1,327 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Benchmarks for media_check.py, run against a synthetic media library (so that no real media
+# library is required to measure its performance).  Discovery and verification are measured
+# against a synthetic directory tree; the database phases (discovery inserts, fetching pending
+# media files and pruning) are measured against synthetic databases of each of the given sizes.
+#
+import argparse
+import fnmatch
+import itertools
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import media_check
+
+__version__ = media_check.__version__
+
+MEDIA_EXTENSIONS = ["avi", "mkv"]
+OTHER_EXTENSIONS = ["jpg", "nfo", "srt"]
+PRUNE_FRACTION = 100
+
+
+def generate_tree(path, files, files_per_directory, roots, depth=2, size=0, sparse=False):
+	"""
+	Create a synthetic library of files under path, in directories of files_per_directory
+	files that are spread evenly over roots top-level directories and nested depth levels deep
+	below them.  One in every four files is a media file (of size bytes, which are either
+	written or, if sparse, left as a hole); the rest are the (empty) sort of clutter that is
+	found alongside media files.
+	"""
+	block = os.urandom(media_check.CHECKSUM_BUFFER_SIZE)
+	for i in range(files):
+		number = i // files_per_directory
+		directory = os.path.join(
+			path,
+			"root{root:02d}".format(root=number % roots),
+			*["{level:06d}".format(level=number // (100 ** level)) for level in range(depth - 1, -1, -1)]
+		)
+		if (i % files_per_directory) == 0:
+			os.makedirs(directory)
+		if (i % 4) == 0:
+			extension = MEDIA_EXTENSIONS[(i // 4) % len(MEDIA_EXTENSIONS)]
+		else:
+			extension = OTHER_EXTENSIONS[i % len(OTHER_EXTENSIONS)]
+		with open(os.path.join(directory, "file{i:08d}.{extension}".format(extension=extension, i=i)), "wb") as f:
+			if (extension not in MEDIA_EXTENSIONS) or (size == 0):
+				continue
+			if sparse:
+				f.truncate(size)
+				continue
+			written = 0
+			while written < size:
+				f.write(block[:size - written])
+				written += min(len(block), size - written)
+	return [os.path.join(path, "root{root:02d}".format(root=root)) for root in range(roots)]
+
+
+def synthetic_media(root, rows):
+	"""
+	Yield (path, size, device, inode) tuples for rows synthetic media files under root, in
+	directories of 100 media files.
+	"""
+	for i in range(rows):
+		yield (os.path.join(root, u"{directory:06d}".format(directory=i // 100), u"file{i:08d}.mkv".format(i=i)), 1, 1, i)
+
+
+def open_database(path):
+	for suffix in ["", "-shm", "-wal"]:
+		if os.path.exists(path + suffix):
+			os.unlink(path + suffix)
+	return quietly(logging.INFO, media_check.MediaDB, path, "wal", "normal", 65536)
+
+
+def database_benchmarks(directory, rows):
+	"""
+	Measure the database phases of a run against a synthetic database of rows media files:
+	inserting them (as discovery does), fetching them all once they are pending verification
+	and pruning 1 in every PRUNE_FRACTION of them.
+	"""
+	path = os.path.join(directory, "benchmark-{rows:d}.sqlite".format(rows=rows))
+	root = os.path.join(unicode(directory, "utf-8"), u"synthetic")
+	db = open_database(path)
+	try:
+		measure("discovery insert", lambda: db.discover(synthetic_media(root, rows))[0])
+		# Make every media file overdue, in ROWID order.
+		with db.transaction():
+			db.cnx.execute("UPDATE media SET checksum_timestamp = ROWID")
+		measure("fetch_pending", lambda: sum(1 for m in db.iterate_pending(time.time(), None, None)))
+		present = set(media[0] for (i, media) in enumerate(synthetic_media(root, rows)) if (i % PRUNE_FRACTION) != 0)
+		measure("prune", quietly, logging.WARNING, media_check.prune_media, db, [root.encode("utf-8")], ["*.mkv"], present, set(), set())
+	finally:
+		db.disconnect()
+		for suffix in ["", "-shm", "-wal"]:
+			if os.path.exists(path + suffix):
+				os.unlink(path + suffix)
+
+
+def verification_benchmark(directory, roots, globs, files, jobs, transcode):
+	"""
+	Measure the throughput of verifying (at most) files of the media files in the synthetic
+	library, jobs at a time: either checksumming them in-process or, if transcode is set,
+	fully verifying them with media_check.verify() (which runs media_check.FFMPEG, ffmpeg or
+	a stand-in for it such as media_check_ffmpeg_stub.sh).
+	"""
+	path = os.path.join(directory, "benchmark-verification.sqlite")
+	db = open_database(path)
+	try:
+		matcher = media_check.compile_globs(globs)
+		db.discover(itertools.islice((media for root in roots for media in media_check.find_media(root, matcher)), files))
+		rows = list(db.iterate_pending(time.time(), None, None))
+		if transcode:
+			threshold = time.time()
+			pool = media_check.VerificationPool(jobs, lambda m: media_check.verify(m, threshold))
+		else:
+			pool = media_check.VerificationPool(jobs, lambda m: media_check.checksum(m.path))
+		start = time.time()
+		for m in rows:
+			pool.submit(m)
+		while pool.busy():
+			pool.collect()
+		elapsed = time.time() - start
+		size = sum(m.size or 0 for m in rows)
+		logging.info("{name:<16s} {elapsed:>9.3f}s ({files:,d} media files, {rate:,.1f} files/s, {bytes:,.0f} bytes/s)".format(bytes=size / elapsed, elapsed=elapsed, files=len(rows), name="verification", rate=len(rows) / elapsed))
+	finally:
+		db.disconnect()
+		for suffix in ["", "-shm", "-wal"]:
+			if os.path.exists(path + suffix):
+				os.unlink(path + suffix)
+
+
+def legacy_walk(roots, globs):
+	"""
+	The discovery walk as it was originally implemented: os.walk() every root in turn and
+	fnmatch.filter() every directory listing once per glob.
+	"""
+	count = 0
+	for root in roots:
+		for directory, directories, files in os.walk(root, topdown=False, followlinks=True):
+			for glob in globs:
+				for file in fnmatch.filter(files, glob):
+					count += 1
+	return count
+
+
+def scandir_walk(roots, globs):
+	count = 0
+	matcher = media_check.compile_globs(globs)
+	for root in roots:
+		for media in media_check.find_media(root, matcher):
+			count += 1
+	return count
+
+
+def concurrent_walk(roots, globs):
+	count = 0
+	for media in media_check.scan_roots(roots, media_check.compile_globs(globs), {}, {}, {}):
+		count += 1
+	return count
+
+
+def measure(name, function, *args):
+	start = time.time()
+	result = function(*args)
+	elapsed = time.time() - start
+	logging.info("{name:<16s} {elapsed:>9.3f}s ({result:,d} media files)".format(elapsed=elapsed, name=name, result=result))
+	return elapsed
+
+
+def quietly(level, function, *args):
+	"""
+	Call function without logging any of the messages (such as schema migrations, or one
+	warning per pruned media file) of up to level that it would otherwise log.
+	"""
+	logging.disable(level)
+	try:
+		return function(*args)
+	finally:
+		logging.disable(logging.NOTSET)
+
+
+def scales(value):
+	try:
+		return [int(rows) for rows in value.split(",")]
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid list of row counts: {value}".format(value=value))
+
+
+def configure():
+	parser = argparse.ArgumentParser(description="Benchmark media_check.py against a synthetic media library.")
+	parser.add_argument(
+		"-d", "--depth",
+		default=2,
+		help="how many levels deep the directories of the synthetic library are nested below its roots (default: %(default)s)",
+		metavar="NLEVELS",
+		type=int
+	)
+	parser.add_argument(
+		"-f", "--files",
+		default=1000000,
+		help="the number of files in the synthetic library (default: %(default)s)",
+		metavar="NFILES",
+		type=int
+	)
+	parser.add_argument(
+		"--ffmpeg",
+		default=media_check.FFMPEG,
+		help="the ffmpeg (or stand-in for it, such as media_check_ffmpeg_stub.sh) with which to transcode media files when --transcode is given (default: %(default)s)",
+		metavar="PATH"
+	)
+	parser.add_argument(
+		"-F", "--files-per-directory",
+		default=100,
+		help="the number of files in each directory of the synthetic library (default: %(default)s)",
+		metavar="NFILES",
+		type=int
+	)
+	parser.add_argument(
+		"-g", "--globs",
+		default=10,
+		help="the number of media globs to search for (default: %(default)s)",
+		metavar="NGLOBS",
+		type=int
+	)
+	parser.add_argument(
+		"-j", "--jobs",
+		default=4,
+		help="the number of media files to verify concurrently (default: %(default)s)",
+		metavar="NJOBS",
+		type=int
+	)
+	parser.add_argument(
+		"-n", "--verifications",
+		default=1000,
+		help="the (maximum) number of media files in the synthetic library to verify (default: %(default)s)",
+		metavar="NFILES",
+		type=int
+	)
+	parser.add_argument(
+		"-R", "--rows",
+		default=[10000, 100000, 1000000],
+		help="a comma-separated list of the database sizes (in media files) at which to measure the database phases (default: 10000,100000,1000000)",
+		metavar="NROWS",
+		type=scales
+	)
+	parser.add_argument(
+		"-r", "--roots",
+		default=4,
+		help="the number of root directories to divide the synthetic library between (default: %(default)s)",
+		metavar="NROOTS",
+		type=int
+	)
+	parser.add_argument(
+		"-s", "--size",
+		default=0,
+		help="the size (in bytes) of each media file in the synthetic library (default: %(default)s)",
+		metavar="BYTES",
+		type=int
+	)
+	parser.add_argument(
+		"-S", "--sparse",
+		action="store_true",
+		default=False,
+		help="create the media files in the synthetic library as sparse files, rather than writing their contents (default: write their contents)"
+	)
+	parser.add_argument(
+		"-t", "--transcode",
+		action="store_true",
+		default=False,
+		help="fully verify (checksum and transcode, with --ffmpeg) media files, rather than only checksumming them in-process (default: checksum only)"
+	)
+	parser.add_argument(
+		"-v", "--verbose",
+		action="count",
+		help="increase the verbosity of the %(prog)s log output (argument can be given multiple times, to a maximum of -vv)"
+	)
+	parser.add_argument(
+		"--version",
+		action="version",
+		help="display %(prog)s version",
+		version="%(prog)s {version}".format(version=__version__)
+	)
+	parser.add_argument(
+		"directory",
+		help="the directory within which the synthetic library is (or will be) created",
+		metavar="DIR"
+	)
+	arguments = parser.parse_args()
+
+	loglevel = logging.INFO
+	if arguments.verbose >= 1:
+		loglevel = logging.DEBUG
+	logging.basicConfig(datefmt="%d %b %Y %H:%M:%S", format="%(asctime)s %(levelname)-8s %(message)s", level=loglevel)
+	logging.debug("arguments: %s", unicode(arguments))
+
+	return arguments
+
+
+if __name__ == "__main__":
+	arguments = configure()
+	# media_check.py runs ffmpeg from /, so the path to it must be absolute.
+	media_check.FFMPEG = os.path.abspath(arguments.ffmpeg)
+
+	roots = [os.path.join(arguments.directory, "root{root:02d}".format(root=root)) for root in range(arguments.roots)]
+	if not all(os.path.isdir(root) for root in roots):
+		logging.info("generating a synthetic library of {files:,d} files in: {directory}".format(directory=arguments.directory, files=arguments.files))
+		roots = generate_tree(arguments.directory, arguments.files, arguments.files_per_directory, arguments.roots, arguments.depth, arguments.size, arguments.sparse)
+
+	# Pad the real media globs out with globs that never match, to model a long --media-glob list.
+	globs = ["*.{extension}".format(extension=extension) for extension in MEDIA_EXTENSIONS]
+	globs += ["*.unmatched{i:d}".format(i=i) for i in range(max(0, arguments.globs - len(globs)))]
+
+	logging.info("discovery ({globs:,d} globs, {roots:,d} roots, scandir {scandir}):".format(globs=len(globs), roots=len(roots), scandir="available" if media_check.scandir is not None else "unavailable"))
+	baseline = measure("os.walk/fnmatch", legacy_walk, roots, globs)
+	measure("find_media", scandir_walk, roots, globs)
+	elapsed = measure("scan_roots", concurrent_walk, roots, globs)
+	logging.info("speedup: {speedup:.2f}x".format(speedup=baseline / elapsed))
+
+	logging.info("verification ({jobs:,d} jobs, {mode}):".format(jobs=arguments.jobs, mode="checksum and transcode" if arguments.transcode else "in-process checksum"))
+	verification_benchmark(arguments.directory, roots, globs, arguments.verifications, arguments.jobs, arguments.transcode)
+
+	for rows in arguments.rows:
+		logging.info("database ({rows:,d} media files):".format(rows=rows))
+		database_benchmarks(arguments.directory, rows)
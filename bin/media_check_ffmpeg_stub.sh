@@ -0,0 +1,20 @@
+#!/bin/sh
+#
+# A stand-in for ffmpeg, for benchmarking media_check.py where ffmpeg is not installed (or the
+# cost of decoding is not of interest), e.g.:
+#   media_check_benchmark.py --transcode --ffmpeg media_check_ffmpeg_stub.sh DIR
+# It reads its input (-i PATH, or -i pipe:0 for standard input) to the end, as ffmpeg would,
+# and reports no problems with it.
+#
+input=
+while [ $# -gt 0 ]; do
+	if [ "$1" = "-i" ]; then
+		input=$2
+		shift
+	fi
+	shift
+done
+if [ "$input" = "pipe:0" ]; then
+	exec cat > /dev/null
+fi
+exec cat -- "$input" > /dev/null
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Tests for media_check.py, run against small media libraries in temporary directories.
+#
+# Run with: python media_check_test.py [-v]
+#
+import argparse
+import collections
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import media_check
+
+CHECKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_check.py")
+
+
+class LibraryTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.database = os.path.join(self.directory, "media.sqlite")
+		os.makedirs(os.path.join(self.directory, "lib", "sub"))
+		for path in ["lib/a.mkv", "lib/sub/b.avi"]:
+			with open(os.path.join(self.directory, path), "wb") as f:
+				f.write("media")
+		# Make the library older than any timestamp granularity, so that its directories are
+		# indexed (and so not listed again while they remain unchanged).
+		for path in ["lib/sub", "lib"]:
+			os.utime(os.path.join(self.directory, path), (time.time() - 3600, time.time() - 3600))
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def check(self, *arguments):
+		with open(os.devnull, "w") as devnull:
+			subprocess.check_call([sys.executable, CHECKER, "--checksum-interval", "0", "--database-path", self.database] + list(arguments), cwd=self.directory, stderr=devnull)
+
+	def paths(self):
+		cnx = sqlite3.connect(self.database)
+		try:
+			return sorted(os.path.normpath(path) for (path,) in cnx.execute("SELECT path FROM media"))
+		finally:
+			cnx.close()
+
+	def test_prune_unchanged_roots(self):
+		# However a root is spelled, the media files directly within it are not pruned when it
+		# is found to be unchanged by a later run.
+		for root in ["lib/", "lib//", "./lib/.", "lib"]:
+			for run in range(3):
+				self.check("--prune", root)
+				self.assertEqual(self.paths(), ["lib/a.mkv", "lib/sub/b.avi"], root)
+			os.unlink(self.database)
+
+
+class FindMediaTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.matcher = media_check.compile_globs(["*.mkv"])
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def create(self, name):
+		with open(os.path.join(self.directory, name), "wb") as f:
+			f.write("media")
+
+	def find(self, index):
+		scanned = {}
+		media = sorted(os.path.basename(path) for (path, size, device, inode) in media_check.find_media(self.directory, self.matcher, index, scanned))
+		return (media, scanned)
+
+	def test_racy_directory(self):
+		# A media file created in the same mtime tick as the previous scan leaves the mtime of
+		# its directory unchanged, but is still found by the next scan.
+		now = int(time.time())
+		self.create("a.mkv")
+		os.utime(self.directory, (now, now))
+		(media, scanned) = self.find({})
+		self.create("b.mkv")
+		os.utime(self.directory, (now, now))
+		self.assertEqual(self.find(scanned)[0], ["a.mkv", "b.mkv"])
+
+	def test_settled_directory(self):
+		# A directory that has not been modified for longer than an mtime tick is not listed
+		# again while it remains unchanged.
+		self.create("a.mkv")
+		os.utime(self.directory, (time.time() - 3600, time.time() - 3600))
+		(media, scanned) = self.find({})
+		self.assertEqual(media, ["a.mkv"])
+		self.assertEqual(self.find(scanned)[0], [])
+
+
+class MediaWatcherTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.library = os.path.join(self.directory, "lib")
+		os.makedirs(os.path.join(self.library, "sub"))
+		for path in ["a.mkv", "sub/b.mkv"]:
+			with open(os.path.join(self.library, path), "wb") as f:
+				f.write("media")
+		self.db = media_check.MediaDB(os.path.join(self.directory, "media.sqlite"))
+		self.watcher = media_check.MediaWatcher(self.db, media_check.compile_globs(["*.mkv"]), collections.deque())
+		self.watcher.add_tree(self.library)
+		self.db.cnx.execute("UPDATE media SET checksum = 'ABCD0123'")
+		self.db.commit()
+
+	def tearDown(self):
+		self.db.disconnect()
+		shutil.rmtree(self.directory)
+
+	def checksums(self):
+		self.watcher.process(0.1)
+		self.watcher.process(0)
+		return dict((os.path.relpath(row["path"], self.library), row["checksum"]) for row in self.db.cnx.execute("SELECT path, checksum FROM media"))
+
+	def test_move_file(self):
+		os.rename(os.path.join(self.library, "a.mkv"), os.path.join(self.library, "c.mkv"))
+		self.assertEqual(self.checksums(), {"c.mkv": "ABCD0123", "sub/b.mkv": "ABCD0123"})
+
+	def test_move_directory(self):
+		os.rename(os.path.join(self.library, "sub"), os.path.join(self.library, "moved"))
+		self.assertEqual(self.checksums(), {"a.mkv": "ABCD0123", "moved/b.mkv": "ABCD0123"})
+		# The moved directory is still watched, under its new path.
+		with open(os.path.join(self.library, "moved", "c.mkv"), "wb") as f:
+			f.write("media")
+		self.assertEqual(self.checksums(), {"a.mkv": "ABCD0123", "moved/b.mkv": "ABCD0123", "moved/c.mkv": None})
+
+	def test_move_out(self):
+		os.rename(os.path.join(self.library, "a.mkv"), os.path.join(self.directory, "a.mkv"))
+		os.rename(os.path.join(self.library, "sub"), os.path.join(self.directory, "sub"))
+		self.assertEqual(self.checksums(), {})
+
+
+class VerifierFitsTest(unittest.TestCase):
+	DEVICE = 1
+	# Small enough to be checksummed in one chunk (so that the checksum is not resumable).
+	SIZE = 50 * 1000 * 1000
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.db = media_check.MediaDB(os.path.join(self.directory, "media.sqlite"))
+
+	def tearDown(self):
+		self.db.disconnect()
+		shutil.rmtree(self.directory)
+
+	def fits(self, seconds, checksum=None, single_read="auto", transcode_mode="full"):
+		"""
+		Return whether a media file of SIZE bytes is predicted to be verified within seconds,
+		on a device that checksums at 10 MB/s and transcodes at 2 MB/s.
+		"""
+		arguments = argparse.Namespace(checksum_interval=14, divide_verification_evenly=False, jobs=1, jobs_per_device=0, max_io_latency=None, max_read_rate=None, maximum_run_time=seconds, single_read=single_read, strong_checksum=None, transcode_error_limit=None, transcode_mode=transcode_mode)
+		verifier = media_check.Verifier(self.db, arguments, time.time())
+		verifier.throughput = {(self.DEVICE, "checksum"): (10e6, 1.0), (self.DEVICE, "transcode"): (2e6, 1.0)}
+		m = media_check.MediaRow(self.db)
+		m.checksum = checksum
+		m.size = self.SIZE
+		return verifier.fits(m, self.DEVICE)
+
+	def test_checksum(self):
+		# A media file that has been checksummed before is only checksummed (for 5 seconds).
+		self.assertTrue(self.fits(7, checksum="ABCD0123"))
+		self.assertFalse(self.fits(3, checksum="ABCD0123"))
+
+	def test_single_read(self):
+		# A new media file is read once, by ffmpeg (for 25 seconds).
+		self.assertTrue(self.fits(27))
+		self.assertFalse(self.fits(23))
+
+	def test_checksum_and_transcode(self):
+		# Without a single read, a new media file is checksummed and then transcoded (for 30
+		# seconds), whether or not the transcode begins with a sample.
+		for (single_read, transcode_mode) in [("never", "full"), ("auto", "quick")]:
+			self.assertTrue(self.fits(32, single_read=single_read, transcode_mode=transcode_mode), transcode_mode)
+			self.assertFalse(self.fits(28, single_read=single_read, transcode_mode=transcode_mode), transcode_mode)
+
+
+if __name__ == "__main__":
+	unittest.main()
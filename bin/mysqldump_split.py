@@ -25,22 +25,649 @@
 #
 
 from __future__ import with_statement
-import gzip
+import binascii
+import collections
+import fnmatch
+import json
 import logging
+import multiprocessing
 import optparse
 import os
+import Queue
 import re
 import sys
+import threading
+import zlib
+
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 __version__ = "$Rev: 17549 $"
 
+# The kinds of line that a dump is made up of, as classified by classify().
+LINE_BLANK = 0
+LINE_COMMENT = 1
+LINE_CONDITIONAL = 2
+LINE_CREATE = 3
+LINE_DATA = 4
+LINE_OTHER = 5
+LINE_UNLOCK = 6
+LINE_USE = 7
+
+# The prefix that identifies each kind of line, keyed by its first two bytes (so that a line
+# can be classified with one dictionary lookup and one prefix comparison).
+LINE_PREFIXES = {
+	"--": ("--", LINE_COMMENT),
+	"/*": ("/*!", LINE_CONDITIONAL),
+	"CR": ("CREATE ", LINE_CREATE),
+	"IN": ("INSERT ", LINE_DATA),
+	"UN": ("UNLOCK ", LINE_UNLOCK),
+	"US": ("USE ", LINE_USE)
+}
+
+# Reading stdin in large blocks keeps the per-line cost of the split loop down.
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Extraction copies table sections out of a dump in blocks of this size.
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Compressed output is compressed in independent blocks of this size, so that
+# the blocks of even a single table can be compressed in parallel.
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+# The file name extension used for each compression format.
+COMPRESSION_EXTENSIONS = {
+	"gzip": ".gz",
+	"lz4": ".lz4",
+	"zstd": ".zst"
+}
+
+# Extended INSERT lines are handed to the conversion workers in batches of about this size,
+# as (like mysqldump's own) they may be short enough that handing them over one at a time
+# would cost more than converting them.
+CONVERSION_BATCH_SIZE = 1024 * 1024
+
+# The field separator and (optional) field enclosure of each delimited data format; both are
+# written so that LOAD DATA can read them with ESCAPED BY '\\' and LINES TERMINATED BY '\n'.
+DELIMITED_FORMATS = {
+	"csv": (",", '"'),
+	"tsv": ("\t", "")
+}
+
+# A quoted string literal in the VALUES of an extended INSERT statement (its contents are
+# left escaped, as LOAD DATA interprets the same backslash escapes that mysqldump writes).
+SQL_STRING_RE = re.compile(r"'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'")
+
+# The characters that may occur in the VALUES of an extended INSERT statement outside of its
+# string literals (numbers, NULL, hexadecimal literals and _binary introducers, with the string
+# literals themselves replaced by NUL bytes), and anything other than an (unprefixed) string
+# literal between two such values (such as b'0101' bit literals, which are not supported).
+SQL_BARE_CHARACTERS = "\0 (),+-.0123456789ABCDEFLNU_abcdefinrxy"
+SQL_BARE_PREFIX_RE = re.compile(r"\0(?:(?<![ (,]\0)|[^),])")
+
+# A hexadecimal literal (as written for binary strings by mysqldump --hex-blob).
+SQL_HEX_RE = re.compile(r"0x([0-9A-Fa-f]+)")
+
+def compress_block(compression, level, data):
+	"""
+	Compress a block of data as a complete, self-contained gzip member (or
+	zstd/lz4 frame).  A stream of such members (or frames) is itself a valid
+	gzip (or zstd/lz4) stream, so blocks can be compressed independently of
+	each other and then simply concatenated.
+	"""
+	if compression == "gzip":
+		compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		return compressor.compress(data) + compressor.flush()
+	elif compression == "lz4":
+		return lz4.frame.compress(data, compression_level=level)
+	elif compression == "zstd":
+		return zstandard.ZstdCompressor(level=level).compress(data)
+
+class CompressionPool:
+	"""
+	A pool of worker threads that compress blocks of data (zlib, lz4 and zstd
+	all release the GIL while compressing, so the blocks really are compressed
+	in parallel).
+	"""
+	def __init__(self, compression, level, jobs):
+		self.compression = compression
+		self.jobs = jobs
+		self.level = level
+		self.tasks = Queue.Queue()
+		self.workers = []
+		for i in range(jobs):
+			worker = threading.Thread(target=self.work)
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
+
+	def shutdown(self):
+		for worker in self.workers:
+			self.tasks.put(None)
+		for worker in self.workers:
+			worker.join()
+
+	def submit(self, data):
+		"""
+		Queue a block of data to be compressed, returning a task whose 'result'
+		is set to the compressed block once its 'done' event is set.
+		"""
+		task = {"data": data, "done": threading.Event(), "error": None, "result": None}
+		self.tasks.put(task)
+		return task
+
+	def work(self):
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				return
+			try:
+				task["result"] = compress_block(self.compression, self.level, task["data"])
+			except Exception, e:
+				task["error"] = e
+			task["data"] = None
+			task["done"].set()
+
+class CompressedFile:
+	"""
+	A (write-only) file object that compresses everything written to it in
+	COMPRESSION_BLOCK_SIZE blocks on a CompressionPool, writing the compressed
+	blocks out in order.  At most a few blocks per worker are in flight at any
+	one time, so that a fast reader cannot run arbitrarily far ahead of the
+	compression workers.
+	"""
+	def __init__(self, path, pool):
+		self.buffer = []
+		self.buffered = 0
+		self.f = open(path, "wb")
+		self.pending = collections.deque()
+		self.pool = pool
+
+	def close(self):
+		if self.f is None:
+			return
+		self.submit()
+		while self.pending:
+			self.finish()
+		self.f.close()
+		self.f = None
+
+	def finish(self):
+		task = self.pending.popleft()
+		task["done"].wait()
+		if task["error"] is not None:
+			raise task["error"]
+		self.f.write(task["result"])
+
+	def submit(self):
+		if self.buffered > 0:
+			self.pending.append(self.pool.submit("".join(self.buffer)))
+			self.buffer = []
+			self.buffered = 0
+		while len(self.pending) > self.pool.jobs * 2:
+			self.finish()
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= COMPRESSION_BLOCK_SIZE:
+			self.submit()
+
+class ChunkedTable:
+	"""
+	A (write-only) file object that splits a table into files that can be
+	restored concurrently: '<table>.schema.sql' (everything before its first
+	INSERT statement), numbered '<table>.<chunk>.sql' chunks of its INSERT
+	statements (each chunk holding at most the given number of rows and/or
+	bytes, except that an INSERT statement is never split), and
+	'<table>.post.sql' (everything after its first INSERT statement that is
+	not itself an INSERT statement, such as re-enabling keys).  The header
+	lines are written to every file, and '<table>.manifest.json' describes
+	the files in the order in which they must be restored: the schema first,
+	then the chunks (in any order), then the post-data statements.
+
+	Rows are counted as the number of '),(' separators in an INSERT statement
+	(plus one), which is exact unless the data itself contains '),(' (in which
+	case chunks are only slightly smaller than requested).
+	"""
+	def __init__(self, path, header, options, pool):
+		self.chunk = None
+		self.chunk_bytes = 0
+		self.chunk_rows = 0
+		self.chunks = []
+		self.header = header
+		self.options = options
+		self.path = path
+		self.pool = pool
+		self.post = None
+		self.schema = self.open("schema")
+
+	def close(self):
+		for f in [self.schema, self.chunk, self.post]:
+			if f is not None:
+				f.close()
+		self.finish_chunk()
+		manifest = {
+			"chunks": self.chunks,
+			"header": len(self.header),
+			"post": self.post is not None and self.filename("post") or None,
+			"schema": self.filename("schema")
+		}
+		with open("%s.manifest.json" % self.path, "wb") as f:
+			json.dump(manifest, f, indent=1, sort_keys=True)
+
+	def filename(self, part):
+		name = "%s.%s.sql" % (os.path.basename(self.path), part)
+		if self.options.compress is not None:
+			name += COMPRESSION_EXTENSIONS[self.options.compress]
+		return name
+
+	def finish_chunk(self):
+		if self.chunk is not None:
+			self.chunks.append({"bytes": self.chunk_bytes, "file": self.filename("%05d" % len(self.chunks)), "rows": self.chunk_rows})
+			self.chunk = None
+
+	def open(self, part):
+		f = open_output("%s.%s.sql" % (self.path, part), self.options, self.pool)
+		for h in self.header:
+			f.write(h)
+		return f
+
+	def write(self, line):
+		if line.startswith("INSERT "):
+			rows = line.count("),(") + 1
+			if self.chunk is not None and ((self.options.chunk_rows and self.chunk_rows + rows > self.options.chunk_rows) or (self.options.chunk_bytes and self.chunk_bytes + len(line) > self.options.chunk_bytes)):
+				self.chunk.close()
+				self.finish_chunk()
+			if self.chunk is None:
+				self.chunk = self.open("%05d" % len(self.chunks))
+				self.chunk_bytes = 0
+				self.chunk_rows = 0
+			self.chunk.write(line)
+			self.chunk_bytes += len(line)
+			self.chunk_rows += rows
+		elif self.chunks or self.chunk is not None:
+			if self.post is None:
+				self.post = self.open("post")
+			self.post.write(line)
+		else:
+			self.schema.write(line)
+
+class ConversionPool:
+	"""
+	A pool of worker processes that convert batches of extended INSERT lines
+	to delimited rows (see convert_inserts(), which is pure Python, so threads
+	would only take turns at it).  With a single job, batches are converted
+	in-process, as handing them to one worker would only add to their cost.
+	"""
+	def __init__(self, data_format, jobs):
+		(self.separator, self.enclosure) = DELIMITED_FORMATS[data_format]
+		self.jobs = jobs
+		self.pool = None
+		if jobs > 1:
+			self.pool = multiprocessing.Pool(jobs)
+
+	def shutdown(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+
+	def submit(self, lines):
+		"""
+		Queue a batch of extended INSERT lines to be converted, returning a task
+		whose get() returns the list of their (rows, error) tuples.
+		"""
+		if self.pool is None:
+			return ConvertedBatch(convert_inserts(lines, self.separator, self.enclosure))
+		return self.pool.apply_async(convert_inserts, (lines, self.separator, self.enclosure))
+
+class ConvertedBatch:
+	"""
+	A batch of extended INSERT lines converted in-process (see ConversionPool).
+	"""
+	def __init__(self, results):
+		self.results = results
+
+	def get(self):
+		return self.results
+
+class DelimitedTable:
+	"""
+	A (write-only) file object that converts the extended INSERT statements of
+	a table (on a ConversionPool) to delimited data files ('<table>.tsv' or
+	'<table>.csv') that can be restored with LOAD DATA, and writes everything
+	else to '<table>.sql', with a LOAD DATA LOCAL INFILE statement for each
+	data file in place of the INSERT statements that it holds (to be run from
+	within the database's directory once the data files have been
+	decompressed).  A new data file ('<table>.<n>.tsv' or '<table>.<n>.csv')
+	is started whenever the column list of the INSERT statements changes, or
+	they are interrupted by any other statement, so that every statement is
+	restored in its original order.  INSERT statements that cannot be
+	converted are written to '<table>.sql' unchanged.  At most a few batches
+	per worker are in flight at any one time.
+	"""
+	def __init__(self, path, header, options, pool, conversion):
+		self.batch = []
+		self.batched = 0
+		self.charset = None
+		for h in header:
+			match = re.search(r'SET NAMES (\w+)', h)
+			if match:
+				self.charset = match.group(1)
+		self.conversion = conversion
+		self.data = None
+		self.files = 0
+		self.options = options
+		self.path = path
+		self.pending = collections.deque()
+		self.pool = pool
+		self.schema = open_output("%s.sql" % path, options, pool)
+		self.target = None
+		for h in header:
+			self.schema.write(h)
+
+	def close(self):
+		self.submit()
+		while self.pending:
+			self.finish()
+		self.finish_data()
+		self.schema.close()
+
+	def finish(self):
+		(task, lines) = self.pending.popleft()
+		if task is None:
+			self.finish_data()
+			self.schema.write(lines[0])
+			return
+		for (line, (rows, error)) in zip(lines, task.get()):
+			if error is not None:
+				logging.warning("[%s] keeping INSERT statement as SQL (%s): %s", self.path, error, line[:80].strip())
+				self.finish_data()
+				self.schema.write(line)
+				continue
+			target = line[len("INSERT INTO "):line.find(" VALUES (")]
+			if (self.data is None) or (target != self.target):
+				self.start_data(target)
+			self.data.write(rows)
+
+	def finish_data(self):
+		if self.data is not None:
+			self.data.close()
+			self.data = None
+
+	def load_statement(self, name, target):
+		(table, columns) = (target.split(" (", 1) + [None])[:2]
+		statement = "LOAD DATA LOCAL INFILE '%s' INTO TABLE %s" % (name, table)
+		if self.charset is not None:
+			statement += " CHARACTER SET %s" % self.charset
+		statement += " FIELDS TERMINATED BY '%s'" % self.conversion.separator.replace("\t", "\\t")
+		if self.conversion.enclosure:
+			statement += " OPTIONALLY ENCLOSED BY '%s'" % self.conversion.enclosure
+		statement += " ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'"
+		if columns is not None:
+			statement += " (%s" % columns
+		return statement + ";\n"
+
+	def start_data(self, target):
+		self.finish_data()
+		self.files += 1
+		if self.files == 1:
+			name = "%s.%s" % (os.path.basename(self.path), self.options.data_format)
+		else:
+			name = "%s.%d.%s" % (os.path.basename(self.path), self.files, self.options.data_format)
+		self.data = open_output(os.path.join(os.path.dirname(self.path), name), self.options, self.pool)
+		self.schema.write(self.load_statement(name, target))
+		self.target = target
+
+	def submit(self):
+		if self.batch:
+			self.pending.append((self.conversion.submit(self.batch), self.batch))
+			self.batch = []
+			self.batched = 0
+
+	def write(self, line):
+		if line.startswith("INSERT "):
+			self.batch.append(line)
+			self.batched += len(line)
+			if self.batched < CONVERSION_BATCH_SIZE:
+				return
+			self.submit()
+		else:
+			self.submit()
+			self.pending.append((None, [line]))
+		while len(self.pending) > self.conversion.jobs * 2:
+			self.finish()
+
+class DumpIndex:
+	"""
+	An index of a dump: the byte offset and length within it of each CREATE
+	DATABASE statement and of each table (from its CREATE TABLE statement to
+	its UNLOCK TABLES statement), along with the header lines that are
+	prepended to each table.  Byte strings are stored as latin-1, which maps
+	every byte to a character and back again unchanged.
+	"""
+	def __init__(self, source=None, size=None):
+		self.databases = []
+		self.header = []
+		self.size = size
+		self.source = source
+		self.tables = []
+
+	def add_database(self, database, offset, length):
+		self.databases.append({"database": database, "offset": offset, "length": length})
+
+	def add_table(self, database, table, offset, length):
+		self.tables.append({"database": database, "table": table, "offset": offset, "length": length})
+
+	def load(self, path):
+		with open(path, "rb") as f:
+			index = json.load(f)
+		self.databases = index["databases"]
+		self.header = [line.encode("latin-1") for line in index["header"]]
+		self.size = index["size"]
+		self.source = index["source"]
+		self.tables = index["tables"]
+
+	def save(self, path):
+		index = {
+			"databases": self.databases,
+			"header": [line.decode("latin-1") for line in self.header],
+			"size": self.size,
+			"source": self.source,
+			"tables": self.tables
+		}
+		with open(path, "wb") as f:
+			json.dump(index, f, indent=1, sort_keys=True)
+
+class NullFile:
+	"""
+	A file object that discards everything written to it (used to split a dump
+	without writing anything out, when only its index is wanted).
+	"""
+	def close(self):
+		pass
+
+	def write(self, data):
+		pass
+
+def copy_section(source, offset, length, output):
+	source.seek(offset)
+	while length > 0:
+		data = source.read(min(COPY_BLOCK_SIZE, length))
+		if not data:
+			raise IOError("unexpected end of dump at byte %d" % source.tell())
+		output.write(data)
+		length -= len(data)
+
+def extract(options):
+	"""
+	Extract the tables that match the --include and --exclude patterns (which
+	are matched against '<database>.<table>') from a dump, using its index
+	(see --index) to seek directly to each of them rather than reading the
+	whole dump.  The tables are written out as main() would have written them
+	(except that any comments and blank lines within them are kept), along
+	with the CREATE DATABASE statements of their databases.  Returns the number
+	of tables extracted.
+	"""
+	index = DumpIndex()
+	index.load(options.extract)
+	source_path = options.input or index.source
+	if source_path is None:
+		raise ValueError("the index does not record the path of its dump (it was read from stdin), so --input is required")
+	if os.path.getsize(source_path) != index.size:
+		raise ValueError("the index does not match the dump (%s is %d bytes, but %d bytes were indexed)" % (source_path, os.path.getsize(source_path), index.size))
+
+	includes = options.include or ["*"]
+	excludes = options.exclude or []
+	tables = []
+	for table in index.tables:
+		name = "%s.%s" % (table["database"], table["table"])
+		if [p for p in includes if fnmatch.fnmatchcase(name, p)] and not [p for p in excludes if fnmatch.fnmatchcase(name, p)]:
+			tables.append(table)
+	databases = set(table["database"] for table in tables)
+
+	pool = None
+	if options.compress is not None:
+		pool = CompressionPool(options.compress, options.compression_level, options.jobs)
+	with open(source_path, "rb") as source:
+		for database in index.databases:
+			if database["database"] in databases:
+				logging.debug("[Byte %d] [CREATE DATABASE] %s", database["offset"], database["database"])
+				f = open_output('%s/%s.sql' % (options.root, database["database"]), options, pool)
+				try:
+					copy_section(source, database["offset"], database["length"], f)
+				finally:
+					f.close()
+		for table in tables:
+			logging.debug("[Byte %d] [CREATE TABLE] %s.%s (%d bytes)", table["offset"], table["database"], table["table"], table["length"])
+			if not os.path.isdir("%s/%s" % (options.root, table["database"])):
+				os.mkdir("%s/%s" % (options.root, table["database"]))
+			f = open_output('%s/%s/%s.sql' % (options.root, table["database"], table["table"]), options, pool)
+			try:
+				for h in index.header:
+					f.write(h)
+				copy_section(source, table["offset"], table["length"], f)
+			finally:
+				f.close()
+	if pool is not None:
+		pool.shutdown()
+	return len(tables)
+
+def escape_delimited(data, separator, enclosure):
+	"""
+	Escape (and enclose, if required) raw data as a field of a delimited data
+	file.
+	"""
+	data = data.replace("\\", "\\\\").replace("\0", "\\0").replace("\n", "\\n").replace("\r", "\\r")
+	if separator == "\t":
+		data = data.replace("\t", "\\t")
+	if enclosure:
+		data = enclosure + data.replace(enclosure, "\\" + enclosure) + enclosure
+	return data
+
+def convert_insert(line, separator, enclosure):
+	"""
+	Convert an extended INSERT line to delimited rows (one per line, with NULL
+	written as \\N), raising ValueError if it contains anything that cannot be
+	converted.  Only the string literals are split out of the line; the rest of
+	its values are converted in bulk (joined by NUL bytes, which can only occur
+	escaped in a dump), and strings are only looked at one by one if the line
+	contains something in them (a doubled quote, a separator or an enclosure)
+	that must be escaped.
+	"""
+	start = line.find(" VALUES (")
+	if start < 0 or not line.startswith("INSERT INTO ") or not line.endswith(");\n"):
+		raise ValueError("not an extended INSERT statement")
+	parts = SQL_STRING_RE.split(line[start + 9:-3])
+	bare = "\0".join(parts[0::2])
+	# The opening parenthesis of the first row precedes the first value, which may be a string.
+	if bare.translate(None, SQL_BARE_CHARACTERS) or SQL_BARE_PREFIX_RE.search("(" + bare):
+		raise ValueError("unsupported value")
+	bare = bare.replace("_binary ", "").replace("),(", "\n").replace("NULL", "\\N")
+	if separator != ",":
+		bare = bare.replace(",", separator)
+	if "0x" in bare:
+		bare = SQL_HEX_RE.sub(lambda m: escape_delimited(binascii.unhexlify(m.group(1)), separator, enclosure), bare)
+	strings = parts[1::2]
+	if "''" in line:
+		strings = [re.sub(r"(\\.)|''", lambda m: m.group(1) or "\\'", s) if "''" in s else s for s in strings]
+	if enclosure:
+		if enclosure in line:
+			strings = [re.sub(r"(\\.)|" + re.escape(enclosure), lambda m: m.group(1) or "\\" + enclosure, s) if enclosure in s else s for s in strings]
+		bare = bare.replace("\0", "%s\0%s" % (enclosure, enclosure))
+	elif "\t" in line:
+		strings = [re.sub(r"(\\.)|\t", lambda m: m.group(1) or "\\t", s) if "\t" in s else s for s in strings]
+	parts[0::2] = bare.split("\0")
+	parts[1::2] = strings
+	parts.append("\n")
+	return "".join(parts)
+
+def convert_inserts(lines, separator, enclosure):
+	"""
+	Convert a batch of extended INSERT lines (see convert_insert()), returning
+	a (rows, error) tuple for each, where error is the ValueError raised for a
+	line that could not be converted (or None).
+	"""
+	results = []
+	for line in lines:
+		try:
+			results.append((convert_insert(line, separator, enclosure), None))
+		except ValueError, e:
+			results.append((None, e))
+	return results
+
+def open_output(path, options, pool):
+	"""
+	Open a SQL file for writing (compressed on the given CompressionPool, if
+	compression is enabled), adding the appropriate file name extension to the
+	given path.
+	"""
+	if options.index_only:
+		return NullFile()
+	if options.compress is None:
+		return open(path, "wb")
+	return CompressedFile(path + COMPRESSION_EXTENSIONS[options.compress], pool)
+
+def classify(line):
+	"""
+	Classify a line of a dump by looking at its first few bytes only, so that
+	the extended INSERT lines that make up the bulk of a dump (and that may be
+	many megabytes long, and contain any bytes at all) are never searched by
+	a regular expression.  Lines that begin with whitespace are classified as
+	LINE_BLANK, as they may be blank (but need not be).
+	"""
+	(prefix, kind) = LINE_PREFIXES.get(line[:2], (None, None))
+	if prefix is not None and line.startswith(prefix):
+		return kind
+	if line[:1].isspace():
+		return LINE_BLANK
+	return LINE_OTHER
+
 def main(options):
 	"""
 	Read a mysqldump SQL file from stdin and split it out into multiple SQL
 	files.  Each database creation is put in its own SQL file (named
 	'<database>.sql'), and each table is also put in its own SQL file (named
-	'<database>/<table>.sql').
+	'<database>/<table>.sql'), unless it is split into chunks (see
+	ChunkedTable) or its data is converted to a delimited data file (see
+	DelimitedTable).
 	"""
+	# The conversion pool's worker processes are forked before any compression
+	# worker threads are started.
+	conversion = None
+	if options.data_format != "sql" and not options.index_only:
+		conversion = ConversionPool(options.data_format, options.jobs)
+	pool = None
+	if options.compress is not None:
+		pool = CompressionPool(options.compress, options.compression_level, options.jobs)
+
 	# Pre-compile our regular expressions for performance reasons.
 	database_creation_re = re.compile('^CREATE DATABASE .* `(.*?)` .*;$')
 	database_start_re = re.compile('^USE `(.*?)`;$')
@@ -62,9 +689,36 @@ def main(options):
 	# Keep an array of 'header' lines to prepend to each table definition.
 	header = []
 
+	# Read (and write) in binary mode, so that BLOBs and data in any character
+	# set are passed through untouched.
+	if options.input is not None:
+		input = open(options.input, "rb", READ_BUFFER_SIZE)
+	else:
+		input = os.fdopen(os.dup(sys.stdin.fileno()), "rb", READ_BUFFER_SIZE)
+
+	# The byte offset of each line, and the database, name and offset of the
+	# current table, are tracked for the index.
+	index = None
+	if options.index is not None:
+		index = DumpIndex(options.input and os.path.abspath(options.input))
+	current_table = None
+	offset = 0
+
+	def index_table(end):
+		if index is not None:
+			index.add_table(current_table[0], current_table[1], current_table[2], end - current_table[2])
+
 	lineno = 0
-	for line in sys.stdin:
+	for line in input:
 		lineno += 1
+		start = offset
+		offset += len(line)
+		kind = classify(line)
+
+		# Data lines within a table need no further inspection.
+		if kind == LINE_DATA and current_table_fd:
+			current_table_fd.write(line)
+			continue
 
 		# Collect any header lines into our 'header' array. We do this before
 		# we drop comments and blank lines so that (if we want/need) some
@@ -82,19 +736,20 @@ def main(options):
 				continue
 
 		# Skip worthless lines (i.e. comments and blank lines) from this point on.
-		if worthless_re.search(line):
+		if kind == LINE_COMMENT or (kind == LINE_BLANK and worthless_re.search(line)):
 			continue
 
 		# Handle CREATE DATABASE statements.
-		match = database_creation_re.search(line)
+		match = None
+		if kind == LINE_CREATE:
+			match = database_creation_re.search(line)
 		if match:
 			logging.debug("[Line %d] [CREATE DATABASE] %s", lineno, line.strip())
-			if not os.path.isdir("%s/%s" % (options.root, match.group(1))):
+			if index is not None:
+				index.add_database(match.group(1), start, len(line))
+			if not options.index_only and not os.path.isdir("%s/%s" % (options.root, match.group(1))):
 				os.mkdir("%s/%s" % (options.root, match.group(1)))
-			if options.gzip:
-				f = gzip.open('%s/%s.sql.gz' % (options.root, match.group(1)), 'w+')
-			else:
-				f = open('%s/%s.sql' % (options.root, match.group(1)), 'w+')
+			f = open_output('%s/%s.sql' % (options.root, match.group(1)), options, pool)
 			try:
 				f.write(line)
 			finally:
@@ -102,7 +757,8 @@ def main(options):
 			continue
 	
 		# Handle USE statements.
-		match = database_start_re.search(line)
+		if kind == LINE_USE:
+			match = database_start_re.search(line)
 		if match:
 			logging.debug("[Line %d] [USE] %s", lineno, line.strip())
 			current_database = match.group(1)
@@ -110,22 +766,28 @@ def main(options):
 				logging.error("[Line %d] database change encountered within table: %s", lineno, line.strip())
 				current_table_fd.close()
 				current_table_fd = None
+				index_table(start)
 			continue
 	
 		# Handle CREATE TABLE statements.
-		match = table_start_re.search(line)
+		if kind == LINE_CREATE:
+			match = table_start_re.search(line)
 		if match:
 			if current_table_fd:
 				logging.error("[Line %d] table creation encountered within table: %s", lineno, line.strip())
 				current_table_fd.close()
 				current_table_fd = None
+				index_table(start)
 			logging.debug("[Line %d] [CREATE TABLE] %s", lineno, line.strip())
-			if options.gzip:
-				current_table_fd = gzip.open('%s/%s/%s.sql.gz' % (options.root, current_database, match.group(1)), 'w+')
+			current_table = (current_database, match.group(1), start)
+			if (options.chunk_rows or options.chunk_bytes) and not options.index_only:
+				current_table_fd = ChunkedTable('%s/%s/%s' % (options.root, current_database, match.group(1)), header, options, pool)
+			elif conversion is not None:
+				current_table_fd = DelimitedTable('%s/%s/%s' % (options.root, current_database, match.group(1)), header, options, pool, conversion)
 			else:
-				current_table_fd = open('%s/%s/%s.sql' % (options.root, current_database, match.group(1)), 'w+')
-			for h in header:
-				current_table_fd.write(h)
+				current_table_fd = open_output('%s/%s/%s.sql' % (options.root, current_database, match.group(1)), options, pool)
+				for h in header:
+					current_table_fd.write(h)
 
 		# Otherwise, we have a plain SQL statement.
 		if current_table_fd:
@@ -140,15 +802,33 @@ def main(options):
 				logging.warning("[Line %d] ignoring bare SQL outside of table: %s", lineno, line.strip())
 
 		# Handle UNLOCK TABLES statements.
-		match = table_end_re.search(line)
+		match = None
+		if kind == LINE_UNLOCK:
+			match = table_end_re.search(line)
 		if match:
 			logging.debug("[Line %d] [UNLOCK TABLES] %s", lineno, line.strip())
 			if current_table_fd:
 				current_table_fd.close()
 				current_table_fd = None
+				index_table(offset)
 			else:
 				logging.error("[Line %d] unlock tables encountered outside of table: %s", lineno, line.strip())
 
+	# Make sure that a table left unterminated by the end of the dump is
+	# completely written out.
+	if current_table_fd:
+		current_table_fd.close()
+		index_table(offset)
+	if conversion is not None:
+		conversion.shutdown()
+	if pool is not None:
+		pool.shutdown()
+
+	if index is not None:
+		index.header = header
+		index.size = offset
+		index.save(options.index)
+
 def parse_arguments():
 	"""
 	Parse command-line arguments and setup an optparse object specifying
@@ -158,17 +838,88 @@ def parse_arguments():
 		usage="%prog [options]",
 		version="%prog r" + re.sub("[^0-9]", "", __version__)
 	)
+	parser.add_option(
+		"--data-format",
+		choices=["csv", "sql", "tsv"],
+		default="sql",
+		help="write the data of each table as SQL INSERT statements, or convert them to delimited data files ('<table>.csv' or '<table>.tsv') that can be restored with LOAD DATA (default: sql)"
+	)
 	parser.add_option(
 		"--debug",
 		action="store_true",
 		default=False,
 		help="enable display of verbose debugging information"
 	)
+	parser.add_option(
+		"--chunk-bytes",
+		default=None,
+		help="split the data of each table into chunks of at most this many bytes (see --chunk-rows)",
+		type="int"
+	)
+	parser.add_option(
+		"--chunk-rows",
+		default=None,
+		help="split the data of each table into chunks of at most this many rows (at INSERT statement boundaries), which can be restored concurrently; the table's schema is written to '<table>.schema.sql', its chunks to '<table>.<chunk>.sql' and the order in which to restore them to '<table>.manifest.json'",
+		type="int"
+	)
+	parser.add_option(
+		"--compress",
+		choices=sorted(COMPRESSION_EXTENSIONS),
+		default=None,
+		help="compress created SQL files with gzip, lz4 (requires the lz4 module) or zstd (requires the zstandard module)"
+	)
+	parser.add_option(
+		"--compression-level",
+		default=None,
+		help="the compression level to use (default: 6 for gzip, 0 for lz4 and 3 for zstd)",
+		type="int"
+	)
+	parser.add_option(
+		"--exclude",
+		action="append",
+		default=[],
+		help="with --extract, do not extract tables whose '<database>.<table>' name matches this (shell-style) pattern (may be given multiple times)"
+	)
+	parser.add_option(
+		"--extract",
+		default=None,
+		help="extract tables from a dump using the given index of it (see --index), rather than splitting it",
+		metavar="INDEX"
+	)
 	parser.add_option(
 		"--gzip",
+		action="store_const",
+		const="gzip",
+		dest="compress",
+		help="enable gzip compression of created SQL files (equivalent to --compress=gzip)"
+	)
+	parser.add_option(
+		"--include",
+		action="append",
+		default=[],
+		help="with --extract, only extract tables whose '<database>.<table>' name matches this (shell-style) pattern (may be given multiple times; default: extract all tables)"
+	)
+	parser.add_option(
+		"--index",
+		default=None,
+		help="write an index of the byte offset of each database and table in the dump to this file (for use with --extract)"
+	)
+	parser.add_option(
+		"--index-only",
 		action="store_true",
 		default=False,
-		help="enable gzip compression of created SQL files"
+		help="only write the index (see --index), rather than also splitting the dump"
+	)
+	parser.add_option(
+		"--input",
+		default=None,
+		help="read the dump from this file, rather than stdin (required for the index to be used by --extract)"
+	)
+	parser.add_option(
+		"--jobs",
+		default=multiprocessing.cpu_count(),
+		help="the number of threads to compress created files with, and of processes to convert INSERT statements to delimited data files with (see --data-format) (default: the number of CPUs)",
+		type="int"
 	)
 	parser.add_option(
 		"--root",
@@ -178,6 +929,23 @@ def parse_arguments():
 	
 	(options, args) = parser.parse_args()
 
+	if options.compress == "lz4" and lz4 is None:
+		parser.error("--compress=lz4 requires the lz4 module")
+	if options.compress == "zstd" and zstandard is None:
+		parser.error("--compress=zstd requires the zstandard module")
+	if options.compression_level is None:
+		options.compression_level = {"gzip": 6, "lz4": 0, "zstd": 3}.get(options.compress)
+	if options.jobs < 1:
+		parser.error("--jobs must be at least 1")
+	if (options.chunk_rows is not None and options.chunk_rows < 1) or (options.chunk_bytes is not None and options.chunk_bytes < 1):
+		parser.error("--chunk-rows and --chunk-bytes must be at least 1")
+	if options.data_format != "sql" and (options.chunk_rows or options.chunk_bytes):
+		parser.error("--data-format %s cannot be combined with --chunk-rows or --chunk-bytes" % options.data_format)
+	if options.index_only and options.index is None:
+		parser.error("--index-only requires --index")
+	if (options.include or options.exclude) and options.extract is None:
+		parser.error("--include and --exclude require --extract")
+
 	if not os.path.isdir(options.root):
 		os.mkdir(options.root)
 
@@ -195,4 +963,12 @@ if __name__ == "__main__":
 
 	logging.debug("options: %s", str(options))
 
-	main(options)
+	if options.extract is not None:
+		try:
+			count = extract(options)
+		except (IOError, ValueError), e:
+			logging.error("unable to extract from dump: %s", e)
+			sys.exit(1)
+		logging.info("extracted %d tables", count)
+	else:
+		main(options)
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Tests for the conversion of extended INSERT statements to delimited data files by
+# mysqldump_split.py (--data-format).  A corpus of awkward values is converted and compared
+# with the expected TSV and CSV rows, and those rows are in turn checked against the values
+# that an independent (character by character) parser reads from the SQL and from the rows
+# (as LOAD DATA would read them), so that the expected output is itself known to be right.
+#
+# Run with: python mysqldump_split_test.py [-v]
+#
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mysqldump_split
+
+SPLITTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mysqldump_split.py")
+
+# The VALUES of an extended INSERT statement, and the TSV and CSV rows that they convert to.
+CORPUS = [
+	("numbers and NULL", "(1,-2.5e-3,NULL,+7)", "1\t-2.5e-3\t\\N\t+7\n", "1,-2.5e-3,\\N,+7\n"),
+	("multiple rows", "(1,'a'),(2,'b'),(3,NULL)", "1\ta\n2\tb\n3\t\\N\n", "1,\"a\"\n2,\"b\"\n3,\\N\n"),
+	("mysqldump escapes", "('\\0\\n\\r\\t\\Z\\\\\\'\\\"\\b')", "\\0\\n\\r\\t\\Z\\\\\\'\\\"\\b\n", "\"\\0\\n\\r\\t\\Z\\\\\\'\\\"\\b\"\n"),
+	("separators within strings", "('),(',',;','(')", "),(\t,;\t(\n", "\"),(\",\",;\",\"(\"\n"),
+	("raw tab", "('a\tb',1)", "a\\tb\t1\n", "\"a\tb\",1\n"),
+	("doubled quote", "('it''s')", "it\\'s\n", "\"it\\'s\"\n"),
+	("escaped backslash before a doubled quote", "('a\\\\''b')", "a\\\\\\'b\n", "\"a\\\\\\'b\"\n"),
+	("unescaped double quote", "('say \"hi\"')", "say \"hi\"\n", "\"say \\\"hi\\\"\"\n"),
+	("strings that look like NULL", "('NULL','\\\\N')", "NULL\t\\\\N\n", "\"NULL\",\"\\\\N\"\n"),
+	("empty strings", "('',1,'')", "\t1\t\n", "\"\",1,\"\"\n"),
+	("hexadecimal blob", "(1,0x00FF5C0A0D092C22)", "1\t\\0\xff\\\\\\n\\r\\t,\"\n", "1,\"\\0\xff\\\\\\n\\r\t,\\\"\"\n"),
+	("_binary introducer", "(_binary 'a\\0b',_binary 0x41)", "a\\0b\tA\n", "\"a\\0b\",\"A\"\n"),
+	("high bytes", "('\xc3\xa9\xff')", "\xc3\xa9\xff\n", "\"\xc3\xa9\xff\"\n"),
+]
+
+# Extended INSERT lines that cannot be converted (and so must be kept as SQL).
+UNCONVERTIBLE = [
+	("bit literal", "INSERT INTO `t` VALUES (1,b'101');\n"),
+	("hexadecimal string literal", "INSERT INTO `t` VALUES (1,X'41');\n"),
+	("character set introducer", "INSERT INTO `t` VALUES (1,_utf8'a');\n"),
+	("INSERT IGNORE", "INSERT IGNORE INTO `t` VALUES (1);\n"),
+	("unterminated statement", "INSERT INTO `t` VALUES (1),(2\n"),
+]
+
+ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+
+def sql_values(values):
+	"""
+	Parse the VALUES of an extended INSERT statement into a list of rows (lists of values,
+	with None for NULL), one character at a time.
+	"""
+	rows = []
+	row = []
+	i = 1
+	while True:
+		if values.startswith("_binary ", i):
+			i += len("_binary ")
+		if values[i] == "'":
+			value = []
+			i += 1
+			while True:
+				if values[i] == "\\":
+					value.append(ESCAPES.get(values[i + 1], values[i + 1]))
+					i += 2
+				elif values.startswith("''", i):
+					value.append("'")
+					i += 2
+				elif values[i] == "'":
+					i += 1
+					break
+				else:
+					value.append(values[i])
+					i += 1
+			row.append("".join(value))
+		else:
+			end = i
+			while values[end] not in ",)":
+				end += 1
+			token = values[i:end]
+			if token == "NULL":
+				row.append(None)
+			elif token.startswith("0x"):
+				row.append(token[2:].decode("hex"))
+			else:
+				row.append(token)
+			i = end
+		if values[i] == ",":
+			i += 1
+			continue
+		rows.append(row)
+		row = []
+		if values.startswith("),(", i):
+			i += 3
+			continue
+		return rows
+
+
+def delimited_values(data, separator, enclosure):
+	"""
+	Parse delimited rows into a list of rows as LOAD DATA would (FIELDS TERMINATED BY
+	separator [OPTIONALLY ENCLOSED BY enclosure] ESCAPED BY '\\' LINES TERMINATED BY '\n').
+	"""
+	rows = []
+	row = []
+	i = 0
+	while i < len(data):
+		value = []
+		raw = []
+		enclosed = bool(enclosure) and (data[i] == enclosure)
+		if enclosed:
+			i += 1
+		while True:
+			if data[i] == "\\":
+				value.append(ESCAPES.get(data[i + 1], data[i + 1]))
+				raw.append(data[i:i + 2])
+				i += 2
+			elif enclosed and (data[i] == enclosure):
+				enclosed = False
+				i += 1
+			elif (not enclosed) and (data[i] in (separator, "\n")):
+				break
+			else:
+				value.append(data[i])
+				raw.append(data[i])
+				i += 1
+		if "".join(raw) == "\\N":
+			row.append(None)
+		else:
+			row.append("".join(value))
+		if data[i] == "\n":
+			rows.append(row)
+			row = []
+		i += 1
+	return rows
+
+
+class ConvertInsertTest(unittest.TestCase):
+	def test_corpus(self):
+		for (name, values, tsv, csv) in CORPUS:
+			line = "INSERT INTO `t` VALUES %s;\n" % values
+			self.assertEqual(mysqldump_split.convert_insert(line, "\t", ""), tsv, name)
+			self.assertEqual(mysqldump_split.convert_insert(line, ",", '"'), csv, name)
+
+	def test_corpus_round_trip(self):
+		for (name, values, tsv, csv) in CORPUS:
+			rows = sql_values(values)
+			self.assertEqual(delimited_values(tsv, "\t", ""), rows, name)
+			self.assertEqual(delimited_values(csv, ",", '"'), rows, name)
+
+	def test_column_list(self):
+		line = "INSERT INTO `t` (`a`, `b`) VALUES (1,'x');\n"
+		self.assertEqual(mysqldump_split.convert_insert(line, "\t", ""), "1\tx\n")
+
+	def test_unconvertible(self):
+		for (name, line) in UNCONVERTIBLE:
+			self.assertRaises(ValueError, mysqldump_split.convert_insert, line, "\t", "")
+			self.assertRaises(ValueError, mysqldump_split.convert_insert, line, ",", '"')
+
+
+class DataFormatTest(unittest.TestCase):
+	DUMP = "".join([
+		"/*!40101 SET NAMES utf8 */;\n",
+		"CREATE DATABASE /*!32312 IF NOT EXISTS*/ `d` /*!40100 DEFAULT CHARACTER SET utf8 */;\n",
+		"USE `d`;\n",
+		"CREATE TABLE `t` (\n",
+		"  `a` int,\n",
+		"  `b` varchar(8)\n",
+		") ENGINE=InnoDB;\n",
+		"LOCK TABLES `t` WRITE;\n",
+		"INSERT INTO `t` (`a`, `b`) VALUES (1,'x'),(2,'y');\n",
+		"INSERT INTO `t` (`a`, `b`) VALUES (3,'z');\n",
+		"INSERT INTO `t` (`b`, `a`) VALUES ('w',4);\n",
+		"INSERT INTO `t` (`a`, `b`) VALUES (5,b'101');\n",
+		"INSERT INTO `t` (`a`, `b`) VALUES (6,'v');\n",
+		"UNLOCK TABLES;\n",
+	])
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.dump = os.path.join(self.directory, "dump.sql")
+		with open(self.dump, "wb") as f:
+			f.write(self.DUMP)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def split(self, data_format, jobs):
+		root = os.path.join(self.directory, "{data_format}-{jobs:d}".format(data_format=data_format, jobs=jobs))
+		with open(os.devnull, "w") as devnull:
+			subprocess.check_call([sys.executable, SPLITTER, "--data-format", data_format, "--input", self.dump, "--jobs", str(jobs), "--root", root], stderr=devnull)
+		table = os.path.join(root, "d")
+		return dict((name, open(os.path.join(table, name), "rb").read()) for name in os.listdir(table))
+
+	def test_data_files(self):
+		files = self.split("tsv", 1)
+		self.assertEqual(sorted(files), ["t.2.tsv", "t.3.tsv", "t.sql", "t.tsv"])
+		self.assertEqual(files["t.tsv"], "1\tx\n2\ty\n3\tz\n")
+		self.assertEqual(files["t.2.tsv"], "w\t4\n")
+		self.assertEqual(files["t.3.tsv"], "6\tv\n")
+		# Every statement is restored in its original order, with its own column list.
+		statements = [line for line in files["t.sql"].splitlines() if line.startswith(("INSERT ", "LOAD DATA ", "UNLOCK "))]
+		load = "LOAD DATA LOCAL INFILE '{name}' INTO TABLE `t` CHARACTER SET utf8 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' {columns};"
+		self.assertEqual(statements, [
+			load.format(columns="(`a`, `b`)", name="t.tsv"),
+			load.format(columns="(`b`, `a`)", name="t.2.tsv"),
+			"INSERT INTO `t` (`a`, `b`) VALUES (5,b'101');",
+			load.format(columns="(`a`, `b`)", name="t.3.tsv"),
+			"UNLOCK TABLES;",
+		])
+
+	def test_parallel_conversion(self):
+		for data_format in ["csv", "tsv"]:
+			self.assertEqual(self.split(data_format, 3), self.split(data_format, 1), data_format)
+
+
+if __name__ == "__main__":
+	unittest.main()